@@ -1,26 +1,218 @@
 import random
 import time
 import copy
-import subprocess
+import asyncio
 import json
 import os
 import threading
+import itertools
+
+from analysis_cache import AnalysisCache
+from ownership import encode_ownership, shape_result
 
 # Paths relative to the workspace root
 KATAGO_EXE = os.path.join("katago", "katago.exe")
 KATAGO_CONFIG = os.path.join("katago", "analysis_example.cfg")
 KATAGO_MODEL = os.path.join("katago", "model.bin.gz")
 
-class KataGoWrapper:
+# 对局规则 (分析缓存的键也包含这两项)
+RULES = "chinese"
+KOMI = 7.5
+
+# KataGo 分析进程数 (多核 CPU 上可开多个进程分担并发的 AI 对局)
+KATAGO_PROCESSES = int(os.environ.get("KATAGO_PROCESSES", "1"))
+
+# 流式分析时 KataGo 推送中间结果的间隔 (秒)
+ANALYSIS_REPORT_EVERY = 0.1
+
+# stdout 单行上限：带 ownership 的回复一行可达数十 KB，超过 asyncio 默认的 64 KB 会读失败
+KATAGO_STREAM_LIMIT = 16 * 1024 * 1024
+
+# 进程监管：启动 + 预热的超时、健康检查间隔、重启退避 (秒)
+KATAGO_START_TIMEOUT = 120
+KATAGO_PING_INTERVAL = 30
+KATAGO_PING_TIMEOUT = 10
+KATAGO_RESTART_BACKOFF = 1
+KATAGO_RESTART_BACKOFF_MAX = 60
+# 稳定运行超过这个时间后，退避时间重新从 KATAGO_RESTART_BACKOFF 开始
+KATAGO_STABLE_UPTIME = 60
+# 进程崩溃时在途查询最多重新发送的次数
+KATAGO_MAX_RESENDS = 2
+# 等待重发的查询：进程连续这么多次没能启动 (或等待超过 KATAGO_START_TIMEOUT 秒) 即报错返回
+KATAGO_MAX_FAILED_STARTS = 3
+
+class PendingQuery:
+    """一个在途查询；analyzeTurns 查询会陆续收到多条回复 (每个 turn 一条)
+
+    带 reportDuringSearchEvery 的查询在搜索过程中还会收到 isDuringSearch 的中间结果，
+    这些只交给 on_progress，不计入完成数。
+    """
+
+    def __init__(self, turns=1, on_result=None, on_progress=None, query=None):
+        self.future = asyncio.get_running_loop().create_future()
+        self.remaining = turns
+        self.results = []
+        self.error = None
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.cancelled = False
+        # 进程崩溃后用于重新发送 (ping 等控制查询为 None，不重发)
+        self.query = query
+        self.sent = False
+        self.resends = 0
+        self.held_since = None  # 开始等待 (重新) 发送的时间
+
+    def resend_query(self):
+        """重发用的查询：analyzeTurns 只保留尚未收到结果的局面"""
+        query = dict(self.query)
+        if "analyzeTurns" in query:
+            done = {r.get("turnNumber") for r in self.results}
+            query["analyzeTurns"] = [t for t in query["analyzeTurns"] if t not in done]
+        return query
+
+    def feed(self, resp):
+        """处理一条回复，返回 True 表示查询已结束"""
+        if "error" in resp:
+            self.finish(resp["error"])
+            return True
+        if "warning" in resp and "turnNumber" not in resp:
+            print(f"[KataGo] warning: {resp['warning']}")
+            return False
+        if self.cancelled and not resp.get("isDuringSearch"):
+            # 已 terminate 的查询可能还会带回搜索量不足的结果，一律丢弃
+            self.finish("terminated")
+            return True
+        if resp.get("noResults"):
+            self.finish("No results")
+            return True
+        if resp.get("isDuringSearch"):
+            if self.on_progress:
+                try:
+                    self.on_progress(resp)
+                except Exception as e:
+                    print(f"[KataGo] progress callback failed: {e}")
+            return False
+
+        self.results.append(resp)
+        if self.on_result:
+            try:
+                self.on_result(resp)
+            except Exception as e:
+                print(f"[KataGo] result callback failed: {e}")
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.finish()
+            return True
+        return False
+
+    def finish(self, error=None):
+        self.error = error
+        if not self.future.done():
+            self.future.set_result(self)
+
+class QueryHandle:
+    """可取消的查询句柄 (只在事件循环中使用)
+
+    发送前取消则查询不再发出；发送后取消则向 KataGo 发送 terminate 动作，
+    等待中的调用随即以 {"error": "terminated"} 返回。
+    """
+
     def __init__(self):
-        self.lock = threading.Lock()
+        self.cancelled = False
+        self.engine = None
+        self.query_id = None
+
+    def bind(self, engine, query_id):
+        """查询发出前调用，已被取消时返回 False"""
+        if self.cancelled:
+            return False
+        self.engine, self.query_id = engine, query_id
+        return True
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.engine:
+            self.engine.terminate(self.query_id)
+
+class KataGoWrapper:
+    """一个 KataGo analysis 进程 (asyncio 子进程)
+
+    查询按 id 多路复用：写入 stdin 后挂起等待，由读协程逐行解析 stdout 并分发给对应查询，
+    在途查询不占用任何线程。
+
+    进程由监管协程 (_supervise) 管理：首次查询或 start() 时在后台启动，先发一个预热查询
+    再接受请求，之后定期 ping；进程退出或 ping 无响应时按指数退避重启，
+    崩溃时在途的查询会在新进程上重新发送 (新进程迟迟起不来时报错返回)。
+    """
+
+    def __init__(self, name="KataGo"):
+        self.name = name
         self.process = None
-        # Start automatically
-        self._start_process()
+        self.loop = None  # 进程及其管道所属的事件循环
+        self.supervisor = None
+        self.reader = None
+        self.ready = None  # asyncio.Event：进程已启动并完成预热
+        self.unavailable = False  # 找不到可执行文件等无法启动的情况
+        # 健康状态：连续失败次数、最近一次错误与重启次数
+        self.failures = 0
+        self.last_error = None
+        self.restarts = 0
+        self.pending = {}  # query_id -> PendingQuery
+        self.query_ids = itertools.count(1)
+
+    def start(self):
+        """在当前事件循环中启动监管协程 (已在运行则忽略)"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # 子进程的管道绑定在创建它的事件循环上，换了循环只能重启
+            self.close()
+            self.loop = loop
+            self.ready = asyncio.Event()
+            self.supervisor = None
+        if self.supervisor is None or self.supervisor.done():
+            self.supervisor = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        """启动进程、预热、定期 ping；进程退出或无响应时按指数退避重启"""
+        delay = KATAGO_RESTART_BACKOFF
+        failed_starts = 0
+        while True:
+            started_at = time.monotonic()
+            await self._start_process()
+            warmed_up = False
+            if self.process:
+                warmed_up = await self._warmup()
+                process = self.process
+                if warmed_up and (process is None or process.returncode is not None):
+                    # 预热完成后、开始监视前进程已退出 (读协程可能已把 self.process 清空)，按启动失败重启
+                    print(f"[{self.name}] Engine exited right after warmup")
+                    warmed_up = False
+                if warmed_up:
+                    failed_starts = 0
+                    self.ready.set()
+                    self._resend_pending()
+                    await self._watch(process)
+                self.ready.clear()
+                await self._stop_process()
+            if not warmed_up:
+                failed_starts += 1
+                if failed_starts >= KATAGO_MAX_FAILED_STARTS or self.unavailable:
+                    # 进程起不来，不让调用方 (及其占用的调度名额) 一直等下去
+                    self._expire_pending(0)
+            if time.monotonic() - started_at > KATAGO_STABLE_UPTIME:
+                delay = KATAGO_RESTART_BACKOFF
+
+            self.restarts += 1
+            print(f"[{self.name}] Engine down, restarting in {delay}s...")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, KATAGO_RESTART_BACKOFF_MAX)
 
-    def _start_process(self):
+    async def _start_process(self):
         if not os.path.exists(KATAGO_EXE):
-            print(f"[KataGo] Error: Executable not found at {KATAGO_EXE}")
+            print(f"[{self.name}] Error: Executable not found at {KATAGO_EXE}")
+            self.unavailable = True
             return
             
         cmd = [
@@ -30,108 +222,329 @@ class KataGoWrapper:
             "-config", KATAGO_CONFIG
         ]
         
-        print(f"[KataGo] Starting engine: {' '.join(cmd)}")
+        print(f"[{self.name}] Starting engine: {' '.join(cmd)}")
         try:
-            self.process = subprocess.Popen(
-                cmd,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                cwd=os.getcwd()
+            self.process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=os.getcwd(),
+                limit=KATAGO_STREAM_LIMIT
             )
-            # Start a thread to read stderr to prevent buffer fill up
-            self.stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
-            self.stderr_thread.start()
+            self.unavailable = False
+            # stderr 持续读空，防止管道写满；stdout 的读协程把每条回复路由到对应的查询
+            asyncio.create_task(self._drain_stderr(self.process))
+            self.reader = asyncio.create_task(self._read_stdout(self.process))
         except Exception as e:
-            print(f"[KataGo] Failed to start: {e}")
+            print(f"[{self.name}] Failed to start: {e}")
+            self.unavailable = True
+            self.process = None
+
+    async def _warmup(self):
+        """发一个 1 visit 的查询，让神经网络初始化的开销不落在第一个真实请求上"""
+        query = {
+            "id": f"w{next(self.query_ids)}",
+            "moves": [],
+            "rules": RULES,
+            "komi": KOMI,
+            "boardXSize": 19,
+            "boardYSize": 19,
+            "maxVisits": 1
+        }
+        started = time.monotonic()
+        if await self._control(query, KATAGO_START_TIMEOUT):
+            print(f"[{self.name}] Warmed up in {time.monotonic() - started:.1f}s")
+            return True
+        print(f"[{self.name}] Warmup failed")
+        return False
+
+    async def _watch(self, process):
+        """进程存活期间每隔 KATAGO_PING_INTERVAL 秒 ping 一次，进程退出或 ping 超时即返回"""
+        exited = asyncio.create_task(process.wait())
+        while True:
+            done, _ = await asyncio.wait({exited}, timeout=KATAGO_PING_INTERVAL)
+            if done:
+                print(f"[{self.name}] Engine exited with code {exited.result()}")
+                return
+            ping = {"id": f"p{next(self.query_ids)}", "action": "query_version"}
+            if not await self._control(ping, KATAGO_PING_TIMEOUT):
+                print(f"[{self.name}] Engine not responding to ping")
+                exited.cancel()
+                return
 
-    def _read_stderr(self):
-        while self.process and self.process.poll() is None:
+    async def _control(self, query, timeout):
+        """发送预热 / ping 等内部查询，超时或出错返回 False"""
+        pending = PendingQuery()
+        self.pending[query["id"]] = pending
+        try:
+            self._write(query)
+            await self.process.stdin.drain()
+            await asyncio.wait_for(asyncio.shield(pending.future), timeout)
+        except Exception:
+            return False
+        finally:
+            self.pending.pop(query["id"], None)
+        return pending.error is None
+
+    async def _stop_process(self):
+        """结束当前进程，并等读协程把在途查询转入待重发状态"""
+        process, reader = self.process, self.reader
+        self.process = None
+        if process and process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        if reader:
             try:
-                line = self.process.stderr.readline()
-                if line:
-                    # Optional: Print logs if needed
-                    # print(f"[KataGo Log] {line.strip()}")
-                    pass
-                else:
-                    time.sleep(0.1)
-            except:
-                break
+                await asyncio.wait_for(reader, KATAGO_PING_TIMEOUT)
+            except Exception:
+                pass
+
+    async def _drain_stderr(self, process):
+        try:
+            while await process.stderr.readline():
+                # Optional: Print logs if needed
+                pass
+        except Exception:
+            pass
+
+    async def _read_stdout(self, process):
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                try:
+                    resp = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"[{self.name}] parse error: {line.strip()}")
+                    continue
+                query = self.pending.get(resp.get("id"))
+                if query and query.feed(resp):
+                    self.pending.pop(resp.get("id"), None)
+        except Exception as e:
+            print(f"[{self.name}] IO Error: {e}")
+
+        print(f"[{self.name}] Engine process ended unexpected.")
+        self._requeue_pending(process)
+
+    def _requeue_pending(self, process):
+        """进程退出：可重发的查询留待新进程重新发送，其余唤醒并报错"""
+        if self.process is process:
+            self.process = None
+        for query_id, query in list(self.pending.items()):
+            if query.cancelled:
+                query.finish("terminated")
+            elif query.query is not None and query.resends < KATAGO_MAX_RESENDS:
+                query.sent = False
+                self._hold(query)
+                continue
+            else:
+                query.finish("No response from KataGo")
+            del self.pending[query_id]
+
+    def _hold(self, query):
+        """查询暂时发不出去：记下时间，超过 KATAGO_START_TIMEOUT 仍未发出就报错"""
+        if query.held_since is None:
+            query.held_since = time.monotonic()
+            asyncio.get_running_loop().call_later(KATAGO_START_TIMEOUT, self._expire_pending)
+
+    def _expire_pending(self, max_age=None):
+        """唤醒等待发送超过 max_age (默认 KATAGO_START_TIMEOUT) 秒的查询并报错"""
+        if max_age is None:
+            max_age = KATAGO_START_TIMEOUT
+        now = time.monotonic()
+        for query_id, query in list(self.pending.items()):
+            if not query.sent and query.held_since is not None and now - query.held_since >= max_age:
+                del self.pending[query_id]
+                query.finish("No response from KataGo")
+
+    def _resend_pending(self):
+        for query in self.pending.values():
+            if query.query is not None and not query.sent:
+                query.resends += 1
+                query.sent = True
+                query.held_since = None
+                self._write(query.resend_query())
+                print(f"[{self.name}] Re-sent query {query.query['id']}")
     
     def close(self):
+        if self.supervisor:
+            self.supervisor.cancel()
+            self.supervisor = None
         if self.process:
-            self.process.terminate()
+            try:
+                self.process.terminate()
+            except ProcessLookupError:
+                pass
             self.process = None
 
-    def analyze(self, moves, max_visits=500):
+    async def _ensure_process(self):
+        """等待进程就绪 (必要时先启动)；无法启动时立即返回 False"""
+        self.start()
+        if self.ready.is_set():
+            return True
+        if self.unavailable:
+            return False
+        try:
+            await asyncio.wait_for(self.ready.wait(), KATAGO_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _write(self, query):
+        self.process.stdin.write((json.dumps(query) + "\n").encode())
+
+    async def _submit(self, query, turns=1, on_result=None, on_progress=None, handle=None):
+        """发送查询并等待其全部回复，返回 PendingQuery"""
+        pending = PendingQuery(turns, on_result, on_progress, query=query)
+        if handle and not handle.bind(self, query["id"]):
+            pending.cancelled = True
+            pending.finish("terminated")
+            return pending
+        self.pending[query["id"]] = pending
+
+        if self.ready.is_set() and self.process:
+            try:
+                # Send Query
+                pending.sent = True
+                self._write(query)
+                await self.process.stdin.drain()
+            except Exception as e:
+                # 进程正在退出：留在 pending 中，由监管协程在新进程上重发
+                print(f"[{self.name}] IO Error: {e}")
+                pending.sent = False
+        if not pending.sent:
+            self._hold(pending)
+
+        try:
+            await pending.future
+        except asyncio.CancelledError:
+            # 调用方被取消，KataGo 那边也不必再算
+            self.terminate(query["id"])
+            raise
+        if pending.error and not pending.cancelled:
+            self._record_failure(pending.error)
+        elif not pending.error:
+            self.failures = 0
+        return pending
+
+    def terminate(self, query_id):
+        """让 KataGo 停止一个在途查询 (排队中或正在搜索)"""
+        pending = self.pending.get(query_id)
+        if not pending:
+            return
+        pending.cancelled = True
+        if not pending.sent or not self.process:
+            # 还没发给 (新的) 进程，直接结束
+            del self.pending[query_id]
+            pending.finish("terminated")
+            return
+        query = {"id": f"t{next(self.query_ids)}", "action": "terminate", "terminateId": query_id}
+        try:
+            self._write(query)
+        except Exception as e:
+            print(f"[{self.name}] IO Error: {e}")
+
+    async def analyze(self, moves, max_visits=500, on_progress=None, priority=0, handle=None,
+                      include_ownership=False, max_time=None):
         """
         moves: list of [color, coord] like [["B", "Q16"], ["W", "D4"]]
+
+        可同时 await 多个，查询会并发地交给 KataGo。
+        include_ownership 为 True 时才让 KataGo 计算 ownership (以 int8 base64 返回)。
+        传入 on_progress 时开启 reportDuringSearchEvery，搜索过程中每隔
+        ANALYSIS_REPORT_EVERY 秒以与最终结果相同的格式回调一次 (在事件循环中调用)。
+        priority 越大，KataGo 的分析线程越优先处理；handle 为 QueryHandle，可用于中途取消。
+        max_time (秒) 给出时，搜索在达到 max_visits 或用时超过 max_time 时结束。
         """
-        if not self.process:
-            print("[KataGo] Engine not running, attempting restart...")
-            self._start_process()
-            if not self.process:
-                return {"error": "KataGo engine unavailable"}
+        if not await self._ensure_process():
+            return {"error": "KataGo engine unavailable"}
 
         # Prepare Query
-        query_id = f"q_{int(time.time()*1000)}"
         query = {
-            "id": query_id,
+            "id": f"q{next(self.query_ids)}",
             "moves": moves,
-            "rules": "chinese",
-            "komi": 7.5,
+            "rules": RULES,
+            "komi": KOMI,
             "boardXSize": 19,
             "boardYSize": 19,
-            "includeOwnership": True,
-            "maxVisits": max_visits
+            "includeOwnership": include_ownership,
+            "maxVisits": max_visits,
+            "priority": priority
         }
+        if max_time:
+            query["overrideSettings"] = {"maxTime": max_time}
+        callback = None
+        if on_progress:
+            query["reportDuringSearchEvery"] = ANALYSIS_REPORT_EVERY
+            callback = lambda resp: on_progress(self._format_response(resp))
         
-        result = None
-        
-        with self.lock:
-            try:
-                # Send Query
-                input_str = json.dumps(query) + "\n"
-                self.process.stdin.write(input_str)
-                self.process.stdin.flush()
-                
-                # Read Response
-                while True:
-                    line = self.process.stdout.readline()
-                    if not line:
-                        print("[KataGo] Engine process ended unexpected.")
-                        self.process = None
-                        break
-                        
-                    try:
-                        resp = json.loads(line)
-                        if resp.get("id") == query_id:
-                            result = resp
-                            break
-                    except json.JSONDecodeError:
-                        print(f"[KataGo] parse error: {line.strip()}")
-            except Exception as e:
-                print(f"[KataGo] IO Error: {e}")
-                self.process = None
-                
-        if not result:
-            return {"error": "No response from KataGo"}
-
-        if "error" in result:
-             return {"error": result["error"]}
+        pending = await self._submit(query, on_progress=callback, handle=handle)
+        if pending.error:
+             return {"error": pending.error}
              
-        return self._format_response(result)
+        return self._format_response(pending.results[0])
+
+    async def analyze_turns(self, moves, max_visits=200, on_turn=None, priority=0, turns=None, handle=None,
+                            max_time=None):
+        """一次 analyzeTurns 查询分析整盘棋的每个局面 (默认第 0 手到终局，也可只给部分 turns)
+
+        每个局面算完时以 format_turn() 的结果回调 on_turn (在事件循环中调用)，
+        全部完成后返回按手数排序的列表。max_time 为每个局面的用时上限 (秒)。
+        """
+        if not await self._ensure_process():
+            return {"error": "KataGo engine unavailable"}
+
+        if turns is None:
+            turns = list(range(len(moves) + 1))
+        query = {
+            "id": f"r{next(self.query_ids)}",
+            "moves": moves,
+            "rules": RULES,
+            "komi": KOMI,
+            "boardXSize": 19,
+            "boardYSize": 19,
+            "analyzeTurns": turns,
+            "maxVisits": max_visits,
+            "priority": priority
+        }
+        if max_time:
+            query["overrideSettings"] = {"maxTime": max_time}
+        callback = (lambda resp: on_turn(format_turn(resp))) if on_turn else None
+        pending = await self._submit(query, turns=len(turns), on_result=callback, handle=handle)
+        if pending.error:
+            return {"error": pending.error}
+
+        return sorted((format_turn(r) for r in pending.results), key=lambda t: t["turn"])
+
+    def _record_failure(self, error):
+        self.failures += 1
+        self.last_error = error
+
+    def is_healthy(self):
+        return (self.ready is not None and self.ready.is_set()
+                and self.process is not None and self.process.returncode is None)
+
+    def load(self):
+        """当前在途的查询数"""
+        return len(self.pending)
+
+    def status(self):
+        return {
+            "name": self.name,
+            "healthy": self.is_healthy(),
+            "in_flight": self.load(),
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "restarts": self.restarts
+        }
 
     def _format_response(self, data):
-        # 1. Ownership: Flattened list -> 19x19 grid (row-major)
+        # 1. Ownership: 361 floats (row-major) -> int8 base64，未请求时省略
         raw_ownership = data.get("ownership", [])
-        formatted_ownership = []
-        if raw_ownership and len(raw_ownership) == 361:
-             for r in range(19):
-                 row_start = r * 19
-                 row_data = raw_ownership[row_start : row_start + 19]
-                 formatted_ownership.append(row_data)
         
         # 2. Move Infos
         move_infos = []
@@ -149,11 +562,145 @@ class KataGoWrapper:
         root_info = data.get("rootInfo", {})
         # Ensure winrate is float if needed
         
-        return {
-            "ownership": formatted_ownership,
+        result = {
             "moveInfos": move_infos, 
             "rootInfo": root_info
         }
+        if raw_ownership and len(raw_ownership) == 361:
+            result["ownership"] = encode_ownership(raw_ownership)
+        return result
+
+def format_turn(data):
+    """analyzeTurns 单个局面的精简结果：胜率、目差、最佳着手与实际搜索量"""
+    root_info = data.get("rootInfo", {})
+    move_infos = data.get("moveInfos", [])
+    return {
+        "turn": data.get("turnNumber", 0),
+        "winrate": round(root_info.get("winrate", 0.5), 4),
+        "scoreLead": round(root_info.get("scoreLead", 0.0), 2),
+        "bestMove": move_infos[0]["move"] if move_infos else None,
+        "visits": root_info.get("visits", 0)
+    }
+
+class KataGoPool:
+    """多个 KataGo 分析进程组成的池，对外提供与 KataGoWrapper 相同的 analyze 接口
+
+    每个查询交给在途查询最少的健康进程；全部不健康时仍选负载最低的一个，
+    由它自己尝试重启。
+
+    analyze / search / analyze_turns 是协程；不在事件循环里的调用方使用
+    analyze_sync / analyze_turns_sync，它们把查询提交到引擎所在的事件循环并阻塞等待
+    (引擎尚未绑定事件循环时，在后台线程里启动一个专用循环)。
+    """
+
+    def __init__(self, size=KATAGO_PROCESSES, cache=None):
+        self.engines = [KataGoWrapper(name=f"KataGo-{i}") for i in range(max(1, size))]
+        self.cache = cache
+        self.loop = None
+        self.loop_lock = threading.Lock()
+
+    def start(self):
+        """在当前事件循环中后台启动并预热所有进程 (不等待就绪)"""
+        self.loop = asyncio.get_running_loop()
+        for e in self.engines:
+            e.start()
+
+    def _pick_engine(self):
+        healthy = [e for e in self.engines if e.is_healthy()]
+        candidates = healthy or self.engines
+        return min(candidates, key=lambda e: (e.load(), e.failures))
+
+    def lookup(self, moves, max_visits=500, ownership=False, territory=False):
+        """只查内存缓存，不发起搜索 (不读缓存文件，可在事件循环中直接调用)"""
+        if self.cache:
+            cached = self.cache.get(moves, max_visits, RULES, KOMI, need_ownership=ownership or territory,
+                                    disk=False)
+            if cached:
+                return shape_result(cached, ownership, territory)
+        return None
+
+    async def lookup_async(self, moves, max_visits=500, ownership=False, territory=False):
+        """查内存与缓存文件 (文件在缓存线程中读取)"""
+        if self.cache:
+            cached = await self.cache.get_async(moves, max_visits, RULES, KOMI,
+                                                need_ownership=ownership or territory)
+            if cached:
+                return shape_result(cached, ownership, territory)
+        return None
+
+    async def analyze(self, moves, max_visits=500, on_progress=None, priority=0, handle=None,
+                      ownership=False, territory=False, max_time=None):
+        """ownership / territory 指定调用方需要的归属数据：
+        int8 base64 的 ownership，和 / 或 行程编码的 territory (见 ownership.py)"""
+        cached = await self.lookup_async(moves, max_visits, ownership, territory)
+        if cached:
+            return cached
+        return await self.search(
+            moves, max_visits=max_visits, on_progress=on_progress, priority=priority, handle=handle,
+            ownership=ownership, territory=territory, max_time=max_time
+        )
+
+    async def search(self, moves, max_visits=500, on_progress=None, priority=0, handle=None,
+                     ownership=False, territory=False, max_time=None):
+        """跳过缓存查询直接搜索，结果写入缓存"""
+        self.loop = asyncio.get_running_loop()
+        callback = None
+        if on_progress:
+            callback = lambda partial: on_progress(shape_result(partial, ownership, territory))
+        result = await self._pick_engine().analyze(
+            moves, max_visits=max_visits, on_progress=callback, priority=priority, handle=handle,
+            include_ownership=ownership or territory, max_time=max_time
+        )
+        if "error" in result:
+            return result
+        if self.cache:
+            visits = max_visits
+            if max_time:
+                # 可能因限时提前结束，按实际搜索量入缓存
+                visits = min(max_visits, result["rootInfo"].get("visits", 0))
+            self.cache.put(moves, visits, RULES, KOMI, result)
+        return shape_result(result, ownership, territory)
+
+    async def analyze_turns(self, moves, max_visits=200, on_turn=None, priority=0, turns=None, handle=None,
+                            max_time=None):
+        self.loop = asyncio.get_running_loop()
+        return await self._pick_engine().analyze_turns(
+            moves, max_visits=max_visits, on_turn=on_turn, priority=priority, turns=turns, handle=handle,
+            max_time=max_time
+        )
+
+    def _sync_loop(self):
+        with self.loop_lock:
+            if self.loop is None or self.loop.is_closed() or not self.loop.is_running():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="katago-loop", daemon=True).start()
+                self.loop = loop
+            return self.loop
+
+    def _call_sync(self, coro):
+        loop = self._sync_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("事件循环内请直接 await analyze()")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def analyze_sync(self, moves, max_visits=500, **kwargs):
+        """同步接口：阻塞当前线程直到分析完成"""
+        return self._call_sync(self.analyze(moves, max_visits=max_visits, **kwargs))
+
+    def analyze_turns_sync(self, moves, max_visits=200, **kwargs):
+        return self._call_sync(self.analyze_turns(moves, max_visits=max_visits, **kwargs))
+
+    def status(self):
+        return [e.status() for e in self.engines]
+
+    def close(self):
+        for e in self.engines:
+            e.close()
 
 # ai_engine = MockKataGoWrapper()
-ai_engine = KataGoWrapper()
+ai_engine = KataGoPool(cache=AnalysisCache())
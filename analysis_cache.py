@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ownership import map_ownership
+
+BOARD_SIZE = 19
+GTP_COLUMNS = "ABCDEFGHJKLMNOPQRST"
+
+# 内存预算与持久化文件 (留空则只缓存在内存中)
+ANALYSIS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ANALYSIS_CACHE_DB = os.environ.get("ANALYSIS_CACHE_DB", "analysis_cache.db")
+# 结果格式版本，参与缓存键；格式变化后旧记录自然失效
+CACHE_FORMAT = 2
+
+def _build_symmetries(size):
+    """8 种棋盘对称 (旋转/翻转) 下每个点的映射表，点编号为 y * size + x (y=0 为第 1 路)"""
+    n = size - 1
+    transforms = [
+        lambda x, y: (x, y),
+        lambda x, y: (n - x, y),
+        lambda x, y: (x, n - y),
+        lambda x, y: (n - x, n - y),
+        lambda x, y: (y, x),
+        lambda x, y: (n - y, x),
+        lambda x, y: (y, n - x),
+        lambda x, y: (n - y, n - x),
+    ]
+    forward = []
+    for transform in transforms:
+        table = [0] * (size * size)
+        for y in range(size):
+            for x in range(size):
+                tx, ty = transform(x, y)
+                table[y * size + x] = ty * size + tx
+        forward.append(table)
+    inverse = []
+    for table in forward:
+        inv = [0] * len(table)
+        for point, mapped in enumerate(table):
+            inv[mapped] = point
+        inverse.append(inv)
+    return forward, inverse
+
+SYMMETRIES, INVERSE_SYMMETRIES = _build_symmetries(BOARD_SIZE)
+
+def _gtp_to_point(coord):
+    """GTP 坐标 -> 点编号；pass 等非棋盘坐标返回 None"""
+    coord = coord.upper()
+    if coord[:1] not in GTP_COLUMNS or not coord[1:].isdigit():
+        return None
+    x = GTP_COLUMNS.index(coord[0])
+    y = int(coord[1:]) - 1
+    if not 0 <= y < BOARD_SIZE:
+        return None
+    return y * BOARD_SIZE + x
+
+def _point_to_gtp(point):
+    y, x = divmod(point, BOARD_SIZE)
+    return f"{GTP_COLUMNS[x]}{y + 1}"
+
+def _map_coord(coord, table):
+    point = _gtp_to_point(coord)
+    return coord if point is None else _point_to_gtp(table[point])
+
+def transform_result(result, table):
+    """把 analyze() 的结果按点映射表整体变换到另一个朝向"""
+    mapped = dict(result)
+    if "ownership" in result:
+        mapped["ownership"] = map_ownership(result["ownership"], table, BOARD_SIZE)
+    mapped["moveInfos"] = [
+        dict(info, move=_map_coord(info["move"], table),
+             pv=[_map_coord(c, table) for c in info.get("pv", [])])
+        for info in result.get("moveInfos", [])
+    ]
+    return mapped
+
+def canonical_key(moves, rules, komi):
+    """在 8 种对称下取字典序最小的着手序列作为规范形式
+
+    返回 (缓存键, 对称编号)；对称编号把查询朝向映射到规范朝向。
+    """
+    best, best_sym = None, 0
+    for sym, table in enumerate(SYMMETRIES):
+        seq = []
+        for color, coord in moves:
+            point = _gtp_to_point(coord)
+            seq.append((color.upper(), -1 if point is None else table[point]))
+        if best is None or seq < best:
+            best, best_sym = seq, sym
+    digest = hashlib.sha1(json.dumps([best, rules, komi, CACHE_FORMAT]).encode()).hexdigest()
+    return digest, best_sym
+
+class AnalysisCache:
+    """按局面缓存 KataGo 分析结果
+
+    - 键为 (规范化着手序列, 规则, 贴目)，8 种对称局面共用一条记录
+    - 记录结果的搜索量 (visits)，更深的结果可以直接回答更浅的请求
+    - 内存中按 LRU 淘汰，总大小不超过 max_bytes
+    - 可选持久化到本地 SQLite 文件，重启后仍然有效；文件读写都在专用线程中进行，
+      写入先排队再批量提交，不阻塞事件循环
+    """
+
+    def __init__(self, max_bytes=ANALYSIS_CACHE_MAX_BYTES, path=ANALYSIS_CACHE_DB):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (visits, 规范朝向的结果 JSON)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        # SQLite 连接只在这个线程里使用
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis-cache")
+        self.write_queue = []  # 待写入文件的 (key, visits, result, updated_at)
+        self.write_scheduled = False
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS analysis_cache ("
+                    "key TEXT PRIMARY KEY, visits INTEGER, result TEXT, updated_at REAL)"
+                )
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"[Cache] 无法打开缓存文件 {path}: {e}")
+                self.db = None
+
+    def get(self, moves, max_visits, rules, komi, need_ownership=False, disk=True):
+        """命中时返回按查询朝向还原的结果，否则返回 None
+
+        need_ownership 为 True 时，没有 ownership 的记录不算命中。
+        disk 为 False 时只查内存 (不计入未命中)，可在事件循环中直接调用；
+        事件循环中的完整查询请用 get_async()。
+        """
+        key, sym = canonical_key(moves, rules, komi)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and disk and self.db:
+            entry = self.executor.submit(self._read, key).result()
+        return self._resolve(key, sym, entry, max_visits, need_ownership, count_miss=disk or not self.db)
+
+    async def get_async(self, moves, max_visits, rules, komi, need_ownership=False):
+        """同 get()，内存未命中时在缓存线程中查文件"""
+        key, sym = canonical_key(moves, rules, komi)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and self.db:
+            entry = await asyncio.get_running_loop().run_in_executor(self.executor, self._read, key)
+        return self._resolve(key, sym, entry, max_visits, need_ownership)
+
+    def _read(self, key):
+        """从文件读一条记录并放入内存 (缓存线程中执行)"""
+        try:
+            row = self.db.execute(
+                "SELECT visits, result FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"[Cache] 读取缓存文件失败: {e}")
+            return None
+        if row is None:
+            return None
+        with self.lock:
+            # 读取期间可能已有更新的 put
+            if key not in self.entries:
+                self._store(key, row)
+            return self.entries[key]
+
+    def _resolve(self, key, sym, entry, max_visits, need_ownership, count_miss=True):
+        with self.lock:
+            result = None
+            if entry is not None and entry[0] >= max_visits:
+                result = json.loads(entry[1])
+                if need_ownership and not result.get("ownership"):
+                    result = None
+            if result is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return transform_result(result, INVERSE_SYMMETRIES[sym])
+
+    def put(self, moves, max_visits, rules, komi, result):
+        key, sym = canonical_key(moves, rules, komi)
+        payload = json.dumps(transform_result(result, SYMMETRIES[sym]))
+        with self.lock:
+            existing = self.entries.get(key)
+            # 按 (是否带 ownership, 搜索量) 比较：带 ownership 的结果总是替换不带的，
+            # 否则形势判断等需要 ownership 的请求会一直未命中、反复重新搜索
+            if existing and ('"ownership"' in existing[1], existing[0]) > ("ownership" in result, max_visits):
+                return
+            self._store(key, (max_visits, payload))
+            if self.db:
+                # 排队由缓存线程批量写入
+                self.write_queue.append((key, max_visits, payload, time.time()))
+                if not self.write_scheduled:
+                    self.write_scheduled = True
+                    self.executor.submit(self._write_pending)
+
+    def _write_pending(self):
+        """把排队的记录在一个事务里写入文件 (缓存线程中执行)"""
+        with self.lock:
+            rows, self.write_queue = self.write_queue, []
+            self.write_scheduled = False
+        try:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO analysis_cache (key, visits, result, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.db.commit()
+        except sqlite3.Error as e:
+            print(f"[Cache] 写入缓存文件失败: {e}")
+
+    def flush(self):
+        """等待排队的写入完成"""
+        if self.db:
+            self.executor.submit(lambda: None).result()
+
+    def _store(self, key, entry):
+        old = self.entries.pop(key, None)
+        if old:
+            self.total_bytes -= len(old[1])
+        self.entries[key] = entry
+        self.total_bytes += len(entry[1])
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted[1])
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending_writes": len(self.write_queue)
+        }
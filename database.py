@@ -1,7 +1,12 @@
-from sqlmodel import SQLModel, Field, create_engine, Session, select
+from sqlmodel import SQLModel, Field, create_engine, Session, select, delete, update
+from sqlalchemy import event, insert, bindparam, Index, or_, tuple_
+from sqlalchemy.orm import aliased
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional
+import asyncio
 import json
+import os
 
 # ==================== 数据模型 ====================
 
@@ -13,16 +18,22 @@ class User(SQLModel, table=True):
 
 class Game(SQLModel, table=True):
     """对局表"""
+    # 大厅列表按状态筛选、按更新时间排序 (SQLite 索引隐含 rowid，即 (status, updated_at, id))
+    __table_args__ = (Index("ix_game_status_updated_at", "status", "updated_at"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    black_player_id: Optional[int] = Field(default=None, foreign_key="user.id")
-    white_player_id: Optional[int] = Field(default=None, foreign_key="user.id")
+    black_player_id: Optional[int] = Field(default=None, foreign_key="user.id", index=True)
+    white_player_id: Optional[int] = Field(default=None, foreign_key="user.id", index=True)
     
     # 状态机: WAITING, PLAYING, ADJOURNED, ENDED
     status: str = Field(default="WAITING")
     
     current_turn: str = Field(default="B")  # 'B' or 'W'
-    moves_json: str = Field(default="[]")   # JSON string of moves
-    ai_winrates_json: str = Field(default="[]") # JSON string of AI winrates per move
+    # 旧版整盘存储的棋谱/胜率，启动时迁移到 Move 表后清空
+    moves_json: str = Field(default="[]")
+    ai_winrates_json: str = Field(default="[]")
+    board_checkpoint: Optional[str] = None  # 周期性棋盘检查点 (见 GameEngine.checkpoint)
+    review_json: Optional[str] = None  # 终局复盘：每手 [胜率, 目差, 最佳着手]
 
     winner: Optional[str] = None  # 'B', 'W', 'Draw'
     result_detail: Optional[str] = None  # "B+Resign", "W+3.5"
@@ -32,19 +43,28 @@ class Game(SQLModel, table=True):
     
     # 辅助方法
     def get_moves(self):
-        return json.loads(self.moves_json)
-    
-    def set_moves(self, moves):
-        self.moves_json = json.dumps(moves)
-    
+        """棋谱 [[color, coord], ...] (读 Move 表)"""
+        if self.id is None:
+            return []
+        return load_moves(self.id)
+
     def get_ai_winrates(self):
+        """按手数排列的黑方胜率，第 n 手在下标 n-1，未分析的为 None"""
+        if self.id is None:
+            return []
+        return load_winrates(self.id)
+
+    def get_review(self):
+        """复盘数据 {"visits": int, "turns": [[winrate, scoreLead, bestMove], ...]}，按手数索引"""
+        if not self.review_json:
+            return None
         try:
-            return json.loads(self.ai_winrates_json)
+            return json.loads(self.review_json)
         except (json.JSONDecodeError, TypeError):
-            return []
+            return None
 
-    def set_ai_winrates(self, winrates):
-        self.ai_winrates_json = json.dumps(winrates)
+    def set_review(self, review):
+        self.review_json = json.dumps(review, separators=(",", ":"))
 
     def get_black_username(self, session):
         if self.black_player_id:
@@ -58,13 +78,119 @@ class Game(SQLModel, table=True):
             return user.username if user else "等待中"
         return "等待中"
 
+class Move(SQLModel, table=True):
+    """棋谱表：每手一行，主键 (game_id, move_no) 即按对局顺序的索引"""
+    game_id: int = Field(foreign_key="game.id", primary_key=True)
+    move_no: int = Field(primary_key=True)  # 从 1 开始
+    color: str  # 'B' or 'W'
+    coord: str  # GTP 坐标或 PASS
+    winrate: Optional[float] = None  # 这一手之后的黑方胜率
+
 # ==================== 数据库初始化 ====================
 
-DATABASE_URL = "sqlite:///lulugo.db"
-engine = create_engine(DATABASE_URL, echo=False)
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///lulugo.db")
+
+# 连接参数配置：tuned 为 WAL + synchronous=NORMAL 等调优设置，default 保持 SQLite 默认 (用于对比)
+DB_PROFILES = {
+    "tuned": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # 负数单位为 KiB，即 64MB
+        "busy_timeout": 5000,  # 毫秒
+        "temp_store": "MEMORY",
+    },
+    "default": {},
+}
+DB_PROFILE = os.environ.get("DB_PROFILE", "tuned")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+# 执行数据库调用的线程数；SQLite 同一时刻只有一个写者，默认单线程也保证了写入顺序
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "1"))
+# 历史对局分页：默认每页条数与单页上限
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "20"))
+HISTORY_PAGE_MAX = 100
+
+def make_engine(url=DATABASE_URL, profile=DB_PROFILE):
+    """创建数据库引擎；SQLite 连接建立时按 profile 设置 PRAGMA"""
+    if not url.startswith("sqlite"):
+        return create_engine(url, echo=False)
+    pragmas = DB_PROFILES[profile]
+    db = create_engine(
+        url, echo=False,
+        # 连接会在 db_executor 的线程与事件循环线程之间复用
+        connect_args={"check_same_thread": False},
+        pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE, pool_pre_ping=False
+    )
+
+    @event.listens_for(db, "connect")
+    def set_pragmas(dbapi_conn, _):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return db
+
+engine = make_engine()
+
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """在 db_executor 中执行同步的数据库函数，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: func(*args, **kwargs))
+
+def _migrate_columns():
+    """为旧数据库补齐模型中新增的列 (create_all 不会修改已存在的表)"""
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table.name})")}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}")
+                    print(f"[Database] 迁移: {table.name}.{column.name}")
+
+def _migrate_indexes():
+    """为旧数据库补建模型中新增的索引"""
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA index_list({table.name})")}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    print(f"[Database] 迁移: 索引 {index.name}")
+
+def _migrate_moves():
+    """把旧版 moves_json / ai_winrates_json 拆成 Move 表的逐手记录"""
+    with get_session() as session:
+        games = session.exec(
+            select(Game).where((Game.moves_json != "[]") | (Game.ai_winrates_json != "[]"))
+        ).all()
+        for game in games:
+            try:
+                moves = json.loads(game.moves_json or "[]")
+                winrates = json.loads(game.ai_winrates_json or "[]")
+            except (json.JSONDecodeError, TypeError):
+                print(f"[Database] 对局 {game.id} 的旧棋谱无法解析，跳过迁移")
+                continue
+            has_rows = session.exec(select(Move.move_no).where(Move.game_id == game.id)).first()
+            if not has_rows:
+                for i, (color, coord) in enumerate(moves):
+                    winrate = winrates[i] if i < len(winrates) else None
+                    session.add(Move(game_id=game.id, move_no=i + 1, color=color, coord=coord, winrate=winrate))
+            game.moves_json = "[]"
+            game.ai_winrates_json = "[]"
+            session.add(game)
+        if games:
+            session.commit()
+            print(f"[Database] 迁移: {len(games)} 局棋谱写入 move 表")
 
 def init_db():
     SQLModel.metadata.create_all(engine)
+    _migrate_columns()
+    _migrate_indexes()
+    _migrate_moves()
     
     # Ensure AI User exists
     with get_session() as session:
@@ -139,58 +265,105 @@ def get_game(game_id: int) -> Optional[Game]:
     with get_session() as session:
         return session.get(Game, game_id)
 
+def _lobby_query(*columns):
+    """对局列表查询：黑白双方用户名一次 LEFT JOIN 取出，不再逐行查询 User"""
+    black, white = aliased(User), aliased(User)
+    return (
+        select(Game.id, black.username, white.username, *columns)
+        .outerjoin(black, Game.black_player_id == black.id)
+        .outerjoin(white, Game.white_player_id == white.id)
+    )
+
 def get_waiting_games():
     """获取所有等待中的对局"""
     with get_session() as session:
-        games = session.exec(select(Game).where(Game.status == "WAITING")).all()
+        rows = session.exec(
+            _lobby_query(Game.black_player_id, Game.white_player_id, Game.status, Game.created_at)
+            .where(Game.status == "WAITING")
+        ).all()
         return [
             {
-                "id": g.id,
-                "black": g.get_black_username(session),
-                "white": g.get_white_username(session),
-                "black_id": g.black_player_id, # 前端需要知道哪个位置是空的
-                "white_id": g.white_player_id, 
-                "status": g.status,
-                "created_at": g.created_at.strftime("%Y-%m-%d %H:%M")
+                "id": game_id,
+                "black": black or "等待中",
+                "white": white or "等待中",
+                "black_id": black_id, # 前端需要知道哪个位置是空的
+                "white_id": white_id, 
+                "status": status,
+                "created_at": created_at.strftime("%Y-%m-%d %H:%M")
             }
-            for g in games
+            for game_id, black, white, black_id, white_id, status, created_at in rows
         ]
 
 def get_playing_games():
     """获取所有进行中的对局"""
     with get_session() as session:
-        games = session.exec(
-            select(Game).where(Game.status.in_(["PLAYING", "ADJOURNED"]))
+        rows = session.exec(
+            _lobby_query(Game.status, Game.updated_at).where(Game.status.in_(["PLAYING", "ADJOURNED"]))
         ).all()
         return [
             {
-                "id": g.id,
-                "black": g.get_black_username(session),
-                "white": g.get_white_username(session),
-                "status": g.status,
-                "updated_at": g.updated_at.strftime("%Y-%m-%d %H:%M")
+                "id": game_id,
+                "black": black or "等待中",
+                "white": white or "等待中",
+                "status": status,
+                "updated_at": updated_at.strftime("%Y-%m-%d %H:%M")
             }
-            for g in games
+            for game_id, black, white, status, updated_at in rows
         ]
 
-def get_history_games():
-    """获取所有已结束的对局"""
+def encode_cursor(updated_at, game_id):
+    """分页游标：按 (updated_at, id) 定位一条历史对局"""
+    return f"{updated_at.isoformat()}_{game_id}"
+
+def decode_cursor(cursor):
+    """解析游标，格式不对时抛出 ValueError"""
+    updated_at, _, game_id = cursor.rpartition("_")
+    return datetime.fromisoformat(updated_at), int(game_id)
+
+def get_history_games(limit=HISTORY_PAGE_SIZE, before=None, since=None, player_id=None):
+    """获取已结束的对局 (按结束时间倒序，键集分页)
+
+    before: 只取该游标之前 (更早) 的对局，即翻下一页
+    since:  只取该游标之后新结束的对局，供前端轮询增量更新
+    player_id: 只取该用户参与的对局
+    返回 {"games", "next_cursor", "latest_cursor", "has_more"}：
+    next_cursor 用于继续向前翻页 (没有更早的对局时为 None)，latest_cursor 供下次 since 使用；
+    since 模式下 has_more 为真表示新对局超过一页，前端应重新加载第一页。
+    """
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    key = tuple_(Game.updated_at, Game.id)
+    query = _lobby_query(Game.winner, Game.result_detail, Game.updated_at).where(Game.status == "ENDED")
+    if before:
+        query = query.where(key < tuple_(*decode_cursor(before)))
+    if since:
+        query = query.where(key > tuple_(*decode_cursor(since)))
+    if player_id is not None:
+        query = query.where(or_(Game.black_player_id == player_id, Game.white_player_id == player_id))
+    # 多取一条判断后面是否还有
+    query = query.order_by(Game.updated_at.desc(), Game.id.desc()).limit(limit + 1)
     with get_session() as session:
-        games = session.exec(
-            select(Game).where(Game.status == "ENDED").order_by(Game.updated_at.desc())
-        ).all()
-        return [
-            {
-                "id": g.id,
-                "black": g.get_black_username(session),
-                "white": g.get_white_username(session),
-                "status": "FINISHED", # 明确返回状态，前端admin需要
-                "winner": g.winner,
-                "result": g.result_detail,
-                "updated_at": g.updated_at.strftime("%Y-%m-%d %H:%M")
-            }
-            for g in games
-        ]
+        rows = session.exec(query).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    games = [
+        {
+            "id": game_id,
+            "black": black or "等待中",
+            "white": white or "等待中",
+            "status": "FINISHED", # 明确返回状态，前端admin需要
+            "winner": winner,
+            "result": result,
+            "updated_at": updated_at.strftime("%Y-%m-%d %H:%M")
+        }
+        for game_id, black, white, winner, result, updated_at in rows
+    ]
+    latest = encode_cursor(rows[0][-1], rows[0][0]) if rows else since
+    return {
+        "games": games,
+        "next_cursor": encode_cursor(rows[-1][-1], rows[-1][0]) if has_more and not since else None,
+        "latest_cursor": latest,
+        "has_more": has_more
+    }
 
 def get_all_users():
     """获取所有用户"""
@@ -198,6 +371,21 @@ def get_all_users():
         users = session.exec(select(User)).all()
         return users
 
+_ai_user_id = None
+
+def get_ai_user_id() -> Optional[int]:
+    """KataGo 账号的 ID (首次查询后缓存，落子时判断轮次无需再开会话)"""
+    global _ai_user_id
+    if _ai_user_id is None:
+        with get_session() as session:
+            _ai_user_id = session.exec(select(User.id).where(User.username == "KataGo")).first()
+    return _ai_user_id
+
+def get_player_names(game: Game) -> tuple[str, str]:
+    """(黑方用户名, 白方用户名)，空位为 "等待中"。"""
+    with get_session() as session:
+        return game.get_black_username(session), game.get_white_username(session)
+
 def get_username(user_id: int) -> Optional[str]:
     with get_session() as session:
         user = session.get(User, user_id)
@@ -220,23 +408,117 @@ def delete_user_and_games(user_id: int):
         
         # 删除对局
         for game in games:
+            session.exec(delete(Move).where(Move.game_id == game.id))
             session.delete(game)
             
         # 删除用户
+        global _ai_user_id
+        if user.id == _ai_user_id:
+            _ai_user_id = None
         session.delete(user)
         session.commit()
         return True, f"删除了用户 {user.username} 和 {len(games)} 个关联对局"
 
-def update_game(game_id: int, **kwargs):
-    """更新对局信息"""
+def delete_game(game_id: int) -> bool:
+    """删除对局及其棋谱"""
+    with get_session() as session:
+        game = session.get(Game, game_id)
+        if not game:
+            return False
+        session.exec(delete(Move).where(Move.game_id == game_id))
+        session.delete(game)
+        session.commit()
+        return True
+
+def save_review(game_id: int, review):
+    """保存复盘结果 (不修改 updated_at，避免打乱历史对局排序)"""
     with get_session() as session:
         game = session.get(Game, game_id)
         if game:
-            for key, value in kwargs.items():
-                setattr(game, key, value)
-            game.updated_at = datetime.now()
+            game.set_review(review)
+            session.add(game)
             session.commit()
 
+def load_moves(game_id: int):
+    with get_session() as session:
+        return _load_moves(session, game_id)
+
+def load_winrates(game_id: int):
+    """第 n 手的胜率在下标 n-1，未分析的为 None (末尾的空缺不返回)"""
+    with get_session() as session:
+        return _load_winrates(session, game_id)
+
+def _load_moves(session, game_id):
+    rows = session.exec(
+        select(Move.color, Move.coord).where(Move.game_id == game_id).order_by(Move.move_no)
+    ).all()
+    return [[color, coord] for color, coord in rows]
+
+def _load_winrates(session, game_id):
+    rows = session.exec(
+        select(Move.move_no, Move.winrate)
+        .where(Move.game_id == game_id, Move.winrate != None)  # noqa: E711
+        .order_by(Move.move_no)
+    ).all()
+    winrates = [None] * (rows[-1][0] if rows else 0)
+    for move_no, winrate in rows:
+        winrates[move_no - 1] = winrate
+    return winrates
+
+def load_game_record(game_id: int):
+    """一次会话读出 (Game, 棋谱, 胜率)，对局不存在时返回 None"""
+    with get_session() as session:
+        game = session.get(Game, game_id)
+        if not game:
+            return None
+        return game, _load_moves(session, game_id), _load_winrates(session, game_id)
+
+def flush_games(batch):
+    """在一个事务里写入多局的改动 (写回队列见 persistence.py)
+
+    batch 中每项为 (game_id, fields, rewrite_from, tail, winrates)：
+    fields 为要更新的 Game 列；rewrite_from 不为 None 时删除该手及之后的 Move 记录，
+    再插入 tail 中的 (color, coord, winrate)；winrates 为 {手数: 胜率}，写到之前已有的记录上。
+    同类语句合并为 executemany，整批只有一次提交。
+    """
+    games, moves = Game.__table__, Move.__table__
+    with engine.begin() as conn:
+        ids = [item[0] for item in batch]
+        existing = set(conn.execute(select(games.c.id).where(games.c.id.in_(ids))).scalars())  # 跳过已删除的对局
+
+        field_groups, deletes, inserts, winrates = {}, [], [], []
+        for game_id, fields, rewrite_from, tail, updates in batch:
+            if game_id not in existing:
+                continue
+            if fields:
+                field_groups.setdefault(tuple(sorted(fields)), []).append(dict(fields, _id=game_id))
+            if rewrite_from is not None:
+                deletes.append({"_id": game_id, "_from": rewrite_from})
+                inserts.extend(
+                    {"game_id": game_id, "move_no": move_no, "color": color, "coord": coord, "winrate": winrate}
+                    for move_no, (color, coord, winrate) in enumerate(tail, start=rewrite_from)
+                )
+            winrates.extend({"_id": game_id, "_no": move_no, "winrate": w} for move_no, w in updates.items())
+
+        for keys, rows in field_groups.items():
+            conn.execute(
+                update(games).where(games.c.id == bindparam("_id")).values({k: bindparam(k) for k in keys}), rows
+            )
+        if deletes:
+            conn.execute(
+                delete(moves).where(moves.c.game_id == bindparam("_id"), moves.c.move_no >= bindparam("_from")),
+                deletes
+            )
+        if inserts:
+            conn.execute(insert(moves), inserts)
+        if winrates:
+            conn.execute(
+                update(moves)
+                .where(moves.c.game_id == bindparam("_id"), moves.c.move_no == bindparam("_no"))
+                .values(winrate=bindparam("winrate")),
+                winrates
+            )
+
 def create_ai_game(creator_id: int) -> Game:
     """创建与AI的对局 (猜先)"""
     with get_session() as session:
@@ -0,0 +1,105 @@
+"""落子持久化的吞吐量对比 (每秒落库的着手数)
+
+    python db_benchmark.py [--games 20] [--moves 100]
+
+在临时数据库上模拟多局同时对弈，比较四种写法：
+  moves-json    改造前的做法：SQLite 默认设置，每手加载 Game 行、整盘重写 moves_json 并提交
+  move-table    SQLite 默认设置，每手一个事务，只追加一条 Move
+  tuned         DB_PROFILES["tuned"] (WAL 等)，每手一个事务，只追加一条 Move
+  write-behind  tuned + GameStore 写回缓存，每一轮 (每局各下一手) 合并成一个事务
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlmodel import SQLModel, Session
+
+import database
+from persistence import GameStore
+
+COLUMNS = "ABCDEFGHJKLMNOPQRST"
+
+def make_moves(count):
+    return [["B" if i % 2 == 0 else "W", f"{COLUMNS[i % 19]}{i // 19 % 19 + 1}"] for i in range(count)]
+
+def setup(path, profile, games):
+    database.engine = database.make_engine(f"sqlite:///{path}", profile)
+    SQLModel.metadata.create_all(database.engine)
+    return [database.create_game(1, 'B').id for _ in range(games)]
+
+def run_moves_json(game_ids, moves):
+    """改造前每手的写法：读出 Game 行，写回整盘棋谱 JSON 与轮次"""
+    for i, (color, _) in enumerate(moves):
+        next_turn = 'W' if color == 'B' else 'B'
+        moves_json = json.dumps(moves[:i + 1])
+        for game_id in game_ids:
+            with Session(database.engine) as session:
+                game = session.get(database.Game, game_id)
+                game.moves_json = moves_json
+                game.current_turn = next_turn
+                game.updated_at = datetime.now()
+                session.commit()
+
+def count_moves_json(game_id):
+    with Session(database.engine) as session:
+        return len(json.loads(session.get(database.Game, game_id).moves_json))
+
+def run_per_move(game_ids, moves):
+    """每手单独提交：更新轮次 + 追加一条 Move"""
+    for i, (color, coord) in enumerate(moves):
+        next_turn = 'W' if color == 'B' else 'B'
+        for game_id in game_ids:
+            database.flush_games([(game_id, {"current_turn": next_turn}, i + 1, [(color, coord, None)], {})])
+
+async def run_write_behind(game_ids, moves):
+    store = GameStore(interval=3600)  # 由下面显式 flush，模拟每个写回周期内各局下一手
+    for game_id in game_ids:
+        await store.get(game_id)
+    for i, (color, _) in enumerate(moves):
+        next_turn = 'W' if color == 'B' else 'B'
+        for game_id in game_ids:
+            store.save_moves(game_id, moves[:i + 1], current_turn=next_turn)
+        await store.flush()
+    store.flush_task.cancel()
+
+def bench(name, profile, games, moves, mode="per-move"):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        game_ids = setup(path, profile, games)
+        started = time.perf_counter()
+        if mode == "write-behind":
+            asyncio.run(run_write_behind(game_ids, moves))
+        elif mode == "moves-json":
+            run_moves_json(game_ids, moves)
+        else:
+            run_per_move(game_ids, moves)
+        elapsed = time.perf_counter() - started
+        count = count_moves_json if mode == "moves-json" else lambda game_id: len(database.load_moves(game_id))
+        stored = sum(count(game_id) for game_id in game_ids)
+        database.engine.dispose()
+    assert stored == games * len(moves), f"{name}: 落库 {stored} 手"
+    total = games * len(moves)
+    print(f"{name:<14}{total:>8}{elapsed:>10.2f}{total / elapsed:>12.0f}")
+    return total / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--moves", type=int, default=100)
+    args = parser.parse_args()
+
+    moves = make_moves(args.moves)
+    print(f"{'':<14}{'moves':>8}{'seconds':>10}{'moves/s':>12}")
+    original = bench("moves-json", "default", args.games, moves, mode="moves-json")
+    move_table = bench("move-table", "default", args.games, moves)
+    tuned = bench("tuned", "tuned", args.games, moves)
+    batched = bench("write-behind", "tuned", args.games, moves, mode="write-behind")
+    print(f"\nmove-table: x{move_table / original:.1f}, tuned: x{tuned / original:.1f}, "
+          f"write-behind: x{batched / original:.1f} (相对改造前的 moves-json)")
+
+if __name__ == "__main__":
+    main()
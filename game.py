@@ -1,42 +1,331 @@
-import copy
-from sgfmill import boards
+import base64
+import hashlib
+import json
+import random
+from array import array
+
+EMPTY, BLACK, WHITE = 0, 1, 2
+
+# 每隔多少手保存一次棋盘检查点 (随棋谱一起落库，加速重新加载)
+CHECKPOINT_INTERVAL = 50
+
+# Zobrist 随机键：每个交叉点 × 黑/白 各一个 64 位整数 (固定种子，保证跨进程一致)
+_ZOBRIST_CACHE = {}
+_NEIGHBOUR_CACHE = {}
+
+def _zobrist_keys(size):
+    """返回 keys[color][point]，color 为 BLACK/WHITE"""
+    keys = _ZOBRIST_CACHE.get(size)
+    if keys is None:
+        rng = random.Random(size)
+        n = size * size
+        keys = (
+            None,
+            [rng.getrandbits(64) for _ in range(n)],
+            [rng.getrandbits(64) for _ in range(n)],
+        )
+        _ZOBRIST_CACHE[size] = keys
+    return keys
+
+def _neighbour_table(size):
+    """预计算每个点 (row * size + col) 的上下左右邻点"""
+    table = _NEIGHBOUR_CACHE.get(size)
+    if table is None:
+        table = []
+        for row in range(size):
+            for col in range(size):
+                neighbours = []
+                for r, c in [(row-1, col), (row+1, col), (row, col-1), (row, col+1)]:
+                    if 0 <= r < size and 0 <= c < size:
+                        neighbours.append(r * size + c)
+                table.append(tuple(neighbours))
+        table = tuple(table)
+        _NEIGHBOUR_CACHE[size] = table
+    return table
+
+def _moves_digest(moves):
+    return hashlib.sha1(json.dumps(moves).encode()).hexdigest()[:16]
+
+class Board:
+    """紧凑棋盘：一维 bytearray 存点 + 邻接表 + 并查集棋串
+
+    每个棋串以并查集的根为代表，根上记录棋子数和伪气数
+    (按“棋子-空点”相邻次数计，同一口气可能被重复计数，但“为 0 即无气”是精确的)。
+    棋串成员用 next_stone 串成循环链表，提子时无需全盘搜索。
+    落子/提子时增量维护，Zobrist Hash 也随之更新。
+    """
+
+    def __init__(self, size=19):
+        self.size = size
+        n = size * size
+        self.points = bytearray(n)
+        self.neighbours = _neighbour_table(size)
+        self.keys = _zobrist_keys(size)
+        self.parent = array('H', range(n))
+        self.next_stone = array('H', range(n))
+        self.stones = array('H', bytes(2 * n))
+        self.libs = array('H', bytes(2 * n))
+        self.hash = 0
+
+    def index(self, row, col):
+        if not (0 <= row < self.size and 0 <= col < self.size):
+            raise IndexError(f"坐标越界: ({row}, {col})")
+        return row * self.size + col
+
+    def find(self, point):
+        parent = self.parent
+        while parent[point] != point:
+            parent[point] = parent[parent[point]]
+            point = parent[point]
+        return point
+
+    def chain_stones(self, point):
+        """沿循环链表列出 point 所在棋串的全部棋子"""
+        stones = [point]
+        nxt = self.next_stone[point]
+        while nxt != point:
+            stones.append(nxt)
+            nxt = self.next_stone[nxt]
+        return stones
+
+    def plan(self, point, color):
+        """预演落子（不修改棋盘），返回 (被提棋子列表, 被提棋子颜色)
+
+        规则与 sgfmill Board.play 一致：先提对方无气的块；
+        若没有可提的对方棋子而己方整块无气，则整块（含落子点）自提。
+        """
+        points, libs = self.points, self.libs
+        opponent = BLACK + WHITE - color
+        has_liberty = False
+        touching = {}  # 相邻棋串的根 -> 与落子点相邻的次数
+        for q in self.neighbours[point]:
+            if points[q] == EMPTY:
+                has_liberty = True
+            else:
+                root = self.find(q)
+                touching[root] = touching.get(root, 0) + 1
+
+        # 棋串的伪气全部来自落子点 -> 落子后无气
+        captured = []
+        for root, count in touching.items():
+            if points[root] == opponent and libs[root] == count:
+                captured.extend(self.chain_stones(root))
+        if captured or has_liberty:
+            return captured, opponent
+
+        for root, count in touching.items():
+            if points[root] == color and libs[root] > count:
+                return captured, opponent
+
+        captured = [point]
+        for root in touching:
+            if points[root] == color:
+                captured.extend(self.chain_stones(root))
+        return captured, color
+
+    def hash_after(self, point, color, captured, captured_color):
+        # 落子异或一次，每颗被提的子再异或一次（自提时落子点两次异或相互抵消）
+        new_hash = self.hash ^ self.keys[color][point]
+        keys = self.keys[captured_color]
+        for stone in captured:
+            new_hash ^= keys[stone]
+        return new_hash
+
+    def play(self, point, color, captured, captured_color):
+        """落子并提走 plan() 算出的棋子"""
+        points, libs, parent = self.points, self.libs, self.parent
+        points[point] = color
+        self.hash ^= self.keys[color][point]
+        parent[point] = point
+        self.next_stone[point] = point
+        self.stones[point] = 1
+
+        liberties = 0
+        for q in self.neighbours[point]:
+            if points[q] == EMPTY:
+                liberties += 1
+            else:
+                libs[self.find(q)] -= 1
+        libs[point] = liberties
+
+        for q in self.neighbours[point]:
+            if points[q] == color:
+                self._union(point, q)
+
+        if captured:
+            self._remove(captured, captured_color)
+
+    def undo(self, point, color, captured, captured_color):
+        """撤销 play()：拿走落下的子，放回被提的子，并重建受影响的棋串"""
+        points, keys = self.points, self.keys
+        if points[point] == color:
+            points[point] = EMPTY
+            self.hash ^= keys[color][point]
+        for stone in captured:
+            if stone != point:
+                points[stone] = captured_color
+                self.hash ^= keys[captured_color][stone]
+
+        seeds = list(self.neighbours[point])
+        for stone in captured:
+            seeds.append(stone)
+            seeds.extend(self.neighbours[stone])
+        self._rebuild_chains(seeds)
+
+    def load(self, points):
+        """从序列化的点阵恢复棋盘（检查点加载用），重建全部棋串和 Hash"""
+        self.points[:] = points
+        self.hash = 0
+        for point, color in enumerate(self.points):
+            if color:
+                self.hash ^= self.keys[color][point]
+        self._rebuild_chains(range(len(self.points)))
+
+    def get_occupied(self):
+        """列出全部棋子 [(point, color), ...]，按行优先顺序"""
+        return [(point, color) for point, color in enumerate(self.points) if color]
+
+    def _union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+        stones = self.stones
+        if stones[ra] < stones[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        stones[ra] += stones[rb]
+        self.libs[ra] += self.libs[rb]
+        # 拼接两个循环链表
+        nxt = self.next_stone
+        nxt[ra], nxt[rb] = nxt[rb], nxt[ra]
+
+    def _remove(self, captured, captured_color):
+        points, libs, keys = self.points, self.libs, self.keys[captured_color]
+        for stone in captured:
+            points[stone] = EMPTY
+            self.hash ^= keys[stone]
+        # 每条“被提子-存活棋子”相邻关系给存活棋串加回一口伪气
+        for stone in captured:
+            for q in self.neighbours[stone]:
+                if points[q] != EMPTY:
+                    libs[self.find(q)] += 1
+
+    def _rebuild_chains(self, seeds):
+        """从 seeds 出发重新展开棋串，重置其并查集、链表与伪气数"""
+        points, neighbours = self.points, self.neighbours
+        seen = set()
+        for seed in seeds:
+            color = points[seed]
+            if color == EMPTY or seed in seen:
+                continue
+            chain = [seed]
+            seen.add(seed)
+            liberties = 0
+            i = 0
+            while i < len(chain):
+                stone = chain[i]
+                i += 1
+                for q in neighbours[stone]:
+                    neigh = points[q]
+                    if neigh == EMPTY:
+                        liberties += 1
+                    elif neigh == color and q not in seen:
+                        seen.add(q)
+                        chain.append(q)
+            for stone, nxt in zip(chain, chain[1:] + chain[:1]):
+                self.parent[stone] = seed
+                self.next_stone[stone] = nxt
+            self.stones[seed] = len(chain)
+            self.libs[seed] = liberties
 
 class GameEngine:
     """游戏引擎 - 无状态单例，每个房间一个实例"""
     
-    def __init__(self, size=19, initial_moves=None):
+    def __init__(self, size=19, initial_moves=None, checkpoint=None):
         self.size = size
-        self.board = boards.Board(size)
+        self.board = Board(size)
         self.history_hashes = set()
-        self.moves = initial_moves or []
+        # 每步一条增量记录 (point, color, captured, captured_color, 落子前Hash)，悔棋时直接弹出
+        self.deltas = []
+        self.moves = []
+        # 盘面版本号与最近一次改动涉及的点 (None 表示无法给出增量)，供增量广播
+        self.seq = 0
+        self._touched = None
         
         self._record_state()
         
-        # 如果有初始棋谱，快速恢复（优化：仅在最后计算Hash，跳过中间步骤以加速加载）
+        # 如果有初始棋谱，逐手增量恢复并记录每个局面（保证打劫历史完整）；
+        # 有可用的检查点时，只需加载检查点再重放其后的几手
         if initial_moves:
-            for color_str, coord in initial_moves:
-                row, col = self._gtp_to_coords(coord)
-                color = 'b' if color_str == 'B' else 'w'
-                self.board.play(row, col, color)
-            self._record_state()
+            start = self._load_checkpoint(checkpoint, initial_moves) if checkpoint else 0
+            self._replay(initial_moves[start:])
+
+    @property
+    def board_hash(self):
+        return self.board.hash
 
     def reset(self):
-        self.board = boards.Board(self.size)
+        self.board = Board(self.size)
         self.history_hashes = set()
+        self.deltas = []
         self.moves = []
         self._record_state()
 
-    def _get_board_fingerprint(self, board_obj):
-        state = []
-        for r in range(self.size):
-            for c in range(self.size):
-                color = board_obj.get(r, c)
-                state.append(color if color else '.')
-        return tuple(state)
-
     def _record_state(self):
-        fingerprint = self._get_board_fingerprint(self.board)
-        self.history_hashes.add(fingerprint)
+        self.history_hashes.add(self.board.hash)
+
+    def _replay(self, moves):
+        """重放已落库的棋谱（合法性已在落子时校验过）"""
+        for color_str, coord in moves:
+            point, color = self._parse_move(color_str, coord)
+            captured, captured_color = self.board.plan(point, color)
+            self._apply_move(point, color, captured, captured_color)
+            self.moves.append([color_str, coord])
+            self._record_state()
+
+    def checkpoint(self):
+        """序列化当前棋盘与历史局面，供重新加载时跳过重放"""
+        hashes = array('Q', self.history_hashes)
+        return json.dumps({
+            "n": len(self.moves),
+            "digest": _moves_digest(self.moves),
+            "board": base64.b64encode(bytes(self.board.points)).decode(),
+            "hashes": base64.b64encode(hashes.tobytes()).decode(),
+        })
+
+    def _load_checkpoint(self, checkpoint, moves):
+        """加载检查点，返回已覆盖的手数；检查点与棋谱不符（如悔棋后重下）时返回 0"""
+        try:
+            data = json.loads(checkpoint)
+            n = data["n"]
+            if n > len(moves) or data["digest"] != _moves_digest(moves[:n]):
+                return 0
+            hashes = array('Q')
+            hashes.frombytes(base64.b64decode(data["hashes"]))
+            self.board.load(base64.b64decode(data["board"]))
+        except Exception as e:
+            print(f"[Engine] 检查点无效，完整重放棋谱: {e}")
+            self.board = Board(self.size)
+            return 0
+
+        self.history_hashes = set(hashes)
+        self.moves = [list(m) for m in moves[:n]]
+        return n
+
+    def _parse_move(self, color_str, gtp_coord):
+        row, col = self._gtp_to_coords(gtp_coord)
+        color = BLACK if color_str == 'B' else WHITE
+        return self.board.index(row, col), color
+
+    def _apply_move(self, point, color, captured, captured_color):
+        self.deltas.append((point, color, captured, captured_color, self.board.hash))
+        self.board.play(point, color, captured, captured_color)
+
+    def _revert_move(self):
+        """弹出最近一步的增量记录：拿走落下的子，放回被提的子"""
+        point, color, captured, captured_color, prev_hash = self.deltas.pop()
+        self.board.undo(point, color, captured, captured_color)
+        self.board.hash = prev_hash
 
     def _gtp_to_coords(self, gtp_vertex):
         gtp_vertex = gtp_vertex.upper()
@@ -56,64 +345,84 @@ class GameEngine:
 
     def play_move(self, color_str, gtp_coord):
         try:
-            row, col = self._gtp_to_coords(gtp_coord)
-            color = 'b' if color_str == 'B' else 'w'
+            point, color = self._parse_move(color_str, gtp_coord)
             
-            if self.board.get(row, col) is not None:
+            if self.board.points[point] != EMPTY:
                 return False, "此处已有棋子"
 
-            temp_board = copy.deepcopy(self.board)
-            
-            try:
-                temp_board.play(row, col, color)
-            except ValueError:
-                return False, "禁入点 (自杀)"
+            # 在原棋盘上预演，算出提子与新 Hash；被拒绝时棋盘从未改动，无需回滚
+            captured, captured_color = self.board.plan(point, color)
+            new_hash = self.board.hash_after(point, color, captured, captured_color)
 
-            new_fingerprint = self._get_board_fingerprint(temp_board)
-            if new_fingerprint in self.history_hashes:
+            # 单子自杀会还原出上一个局面，因此同样落入同形判定
+            if new_hash in self.history_hashes:
                 return False, "非法落子：全局同形禁手 (打劫/Ko)"
 
-            self.board = temp_board
+            self._apply_move(point, color, captured, captured_color)
             self.moves.append([color_str, gtp_coord]) 
             self._record_state()
+            self.seq += 1
+            self._touched = [point] + captured
             
             return True, None
 
         except Exception as e:
             return False, f"引擎错误: {str(e)}"
         
-    def undo_move(self):
+    def undo_move(self, steps=1):
+        if steps < 1:
+            raise ValueError(f"悔棋步数必须至少为 1: {steps}")
         if not self.moves:
             return False, "无棋可悔"
 
-        self.moves.pop()
-        self.board = boards.Board(self.size)
-        self.history_hashes = set()
-        self._record_state() 
-
-        try:
-            for color_str, coord in self.moves:
-                row, col = self._gtp_to_coords(coord)
-                color = 'b' if color_str == 'B' else 'w'
-                self.board.play(row, col, color)
-                self._record_state()
-        except Exception as e:
-            print(f"Undo 严重错误: {e}")
+        steps = min(steps, len(self.moves))
+        if steps > len(self.deltas):
+            # 检查点之前的手没有增量记录，退回到完整重放
+            moves = self.moves[:len(self.moves) - steps]
             self.reset()
-            return True, "历史数据损坏，已重置棋盘"
+            self._replay(moves)
+            self.seq += 1
+            self._touched = None
+            return True, None
+
+        touched = []
+        for _ in range(steps):
+            # 同形禁手保证历史局面互不重复，直接移除当前局面即可
+            self.history_hashes.discard(self.board.hash)
+            point, _, captured, _, _ = self.deltas[-1]
+            touched.append(point)
+            touched.extend(captured)
+            self._revert_move()
+            self.moves.pop()
+        self.seq += 1
+        self._touched = touched
             
         return True, None
 
     def get_current_stones(self):
         stones = []
-        for row in range(self.size):
-            for col in range(self.size):
-                color = self.board.get(row, col)
-                if color:
-                    c_str = "B" if color == 'b' else "W"
-                    coord = self._coords_to_gtp(row, col)
-                    stones.append([c_str, coord])
+        for point, color in self.board.get_occupied():
+            c_str = "B" if color == BLACK else "W"
+            coord = self._coords_to_gtp(*divmod(point, self.size))
+            stones.append([c_str, coord])
         return stones
 
+    def get_delta(self):
+        """最近一次落子/悔棋的盘面增量：add 为新出现的棋子，remove 为变空的点
+
+        无法给出增量时返回 None，调用方应改发完整盘面
+        """
+        if self._touched is None:
+            return None
+        add, remove = [], []
+        for point in dict.fromkeys(self._touched):
+            coord = self._coords_to_gtp(*divmod(point, self.size))
+            color = self.board.points[point]
+            if color:
+                add.append(["B" if color == BLACK else "W", coord])
+            else:
+                remove.append(coord)
+        return {"seq": self.seq, "add": add, "remove": remove}
+
     def get_history(self):
         return self.moves
@@ -1,5 +1,6 @@
 import socketio
-import json
+from datetime import datetime
+from typing import Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
@@ -7,10 +8,13 @@ from pydantic import BaseModel
 import uvicorn
 
 from database import init_db, create_user, get_user_by_username, create_game, create_ai_game, get_game
-from database import get_waiting_games, get_playing_games, get_history_games, update_game
-from database import get_all_users, delete_user_and_games, get_session, User, select, get_username
-from game import GameEngine
+from database import get_waiting_games, get_playing_games, get_history_games, delete_game
+from database import get_all_users, delete_user_and_games, get_username
+from database import save_review, get_ai_user_id, get_player_names, run_db, HISTORY_PAGE_SIZE
+from game import GameEngine, CHECKPOINT_INTERVAL
 from ai import ai_engine
+from scheduler import ai_scheduler
+from persistence import game_store
 import asyncio
 
 # ==================== 初始化 ====================
@@ -25,10 +29,57 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 application = socketio.ASGIApp(sio, other_asgi_app=app)
 
+@app.on_event("startup")
+async def start_ai_engine():
+    # KataGo 在后台启动并预热，不阻塞服务启动；未就绪时到来的查询会等待它
+    ai_engine.start()
+
+@app.on_event("startup")
+async def load_ai_user():
+    # 预先缓存 KataGo 账号 ID，落子时判断轮次不再访问数据库
+    await run_db(get_ai_user_id)
+
+@app.on_event("shutdown")
+async def flush_games_on_shutdown():
+    await game_store.flush()
+    ai_engine.cache.flush()
+
 # 全局状态管理
 active_games = {}  # {game_id: GameEngine实例}
 user_sessions = {}  # {sid: user_id}
 
+def load_engine(record):
+    """从对局记录 (game_store.get) 恢复游戏引擎（优先使用棋盘检查点）"""
+    return GameEngine(initial_moves=record.moves, checkpoint=record.game.board_checkpoint)
+
+def save_moves(game_id, engine, next_turn):
+    """保存棋谱 (写回缓存，稍后批量落库)；每隔 CHECKPOINT_INTERVAL 手附带保存一次棋盘检查点"""
+    fields = {"current_turn": next_turn}
+    if engine.moves and len(engine.moves) % CHECKPOINT_INTERVAL == 0:
+        fields["board_checkpoint"] = engine.checkpoint()
+    game_store.save_moves(game_id, engine.moves, **fields)
+
+def is_ai_player(game, color):
+    ai_id = get_ai_user_id()
+    player_id = game.black_player_id if color == 'B' else game.white_player_id
+    return ai_id is not None and player_id == ai_id
+
+async def broadcast_board_change(game_id, engine, turn, last_move):
+    """向房间广播盘面增量 (落子/悔棋)；引擎给不出增量时退回完整快照"""
+    payload = {
+        "game_id": game_id,
+        "turn": turn,
+        "last_move": last_move,
+        "status": "PLAYING"
+    }
+    delta = engine.get_delta()
+    if delta is None:
+        payload.update(moves=engine.get_current_stones(), seq=engine.seq)
+        await sio.emit("board_update", payload, room=f"game_{game_id}")
+    else:
+        payload.update(delta)
+        await sio.emit("board_delta", payload, room=f"game_{game_id}")
+
 # ==================== HTTP API ====================
 
 class RegisterRequest(BaseModel):
@@ -47,7 +98,7 @@ async def root():
 
 @app.post("/api/register")
 async def register(req: RegisterRequest):
-    success, msg, user = create_user(req.username)
+    success, msg, user = await run_db(create_user, req.username)
     if not success:
         raise HTTPException(status_code=400, detail=msg)
     print(f"[Register] New user registered: {user.username} (ID: {user.id})")
@@ -55,7 +106,7 @@ async def register(req: RegisterRequest):
 
 @app.post("/api/login")
 async def login(req: LoginRequest):
-    user = get_user_by_username(req.username)
+    user = await run_db(get_user_by_username, req.username)
     if not user:
         raise HTTPException(status_code=404, detail="用户不存在")
     print(f"[Login] User logged in: {user.username} (ID: {user.id})")
@@ -69,66 +120,84 @@ async def logout(req: LoginRequest):
 
 @app.post("/api/games/create")
 async def api_create_game(req: CreateGameRequest):
-    game = create_game(req.user_id, req.color)
+    game = await run_db(create_game, req.user_id, req.color)
     return {"success": True, "game_id": game.id}
 
 @app.post("/api/games/create_ai")
 async def api_create_ai_game(req: CreateGameRequest):
-    game = create_ai_game(req.user_id)
+    game = await run_db(create_ai_game, req.user_id)
     return {"success": True, "game_id": game.id}
 
 @app.get("/api/games/waiting")
 async def api_waiting_games():
-    return {"games": get_waiting_games()}
+    return {"games": await run_db(get_waiting_games)}
 
 @app.get("/api/games/playing")
 async def api_playing_games():
-    return {"games": get_playing_games()}
+    return {"games": await run_db(get_playing_games)}
 
 @app.get("/api/games/history")
-async def api_history_games():
-    return {"games": get_history_games()}
+async def api_history_games(limit: int = HISTORY_PAGE_SIZE, before: Optional[str] = None,
+                            since: Optional[str] = None, player_id: Optional[int] = None):
+    # before 翻页、since 增量轮询，游标取自上一次响应的 next_cursor / latest_cursor
+    try:
+        return await run_db(get_history_games, limit, before, since, player_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
 
 @app.get("/api/games/{game_id}")
 async def api_get_game(game_id: int):
-    game = get_game(game_id)
+    # 进行中的对局以写回缓存里的状态为准
+    record = game_store.peek(game_id)
+    game = record.game if record else await run_db(get_game, game_id)
     if not game:
         raise HTTPException(status_code=404, detail="对局不存在")
     
-    from database import get_session
-    with get_session() as session:
-        return {
-            "id": game.id,
-            "black": game.get_black_username(session),
-            "white": game.get_white_username(session),
-            "status": game.status,
-            "moves": game.get_moves(),
-            "current_turn": game.current_turn,
-            "winner": game.winner,
-            "result": game.result_detail,
-            "ai_winrates": game.get_ai_winrates()
-        }
+    black, white = await run_db(get_player_names, game)
+    return {
+        "id": game.id,
+        "black": black,
+        "white": white,
+        "status": game.status,
+        "moves": list(record.moves) if record else await run_db(game.get_moves),
+        "current_turn": game.current_turn,
+        "winner": game.winner,
+        "result": game.result_detail,
+        "ai_winrates": game_store.get_winrates(game_id) if record else await run_db(game.get_ai_winrates)
+    }
+
+@app.get("/api/games/{game_id}/review")
+async def api_get_review(game_id: int):
+    game = await run_db(get_game, game_id)
+    if not game:
+        raise HTTPException(status_code=404, detail="对局不存在")
+    return {"review": game.get_review()}
 
 @app.delete("/api/games/{game_id}")
 async def api_delete_game(game_id: int):
     # 简单的管理员删除接口，实际应用应该鉴权
-    from database import get_session, Game
-    with get_session() as session:
-        game = session.get(Game, game_id)
-        if game:
-            session.delete(game)
-            session.commit()
-            return {"success": True}
+    if await run_db(delete_game, game_id):
+        game_store.discard(game_id)
+        return {"success": True}
     raise HTTPException(status_code=404, detail="Game not found")
 
+@app.get("/api/ai/status")
+async def api_ai_status():
+    return {
+        "engines": ai_engine.status(),
+        "cache": ai_engine.cache.stats(),
+        "scheduler": ai_scheduler.stats(),
+        "store": game_store.stats()
+    }
+
 @app.get("/api/users")
 async def api_get_users():
-    users = get_all_users()
+    users = await run_db(get_all_users)
     return {"users": users}
 
 @app.delete("/api/users/{user_id}")
 async def api_delete_user(user_id: int):
-    success, msg = delete_user_and_games(user_id)
+    success, msg = await run_db(delete_user_and_games, user_id)
     if not success:
         raise HTTPException(status_code=404, detail=msg)
     return {"success": True, "msg": msg}
@@ -163,10 +232,11 @@ async def join_room(sid, data):
         await sio.emit("error", {"msg": "未认证"}, to=sid)
         return
     
-    game = get_game(game_id)
-    if not game:
+    record = await game_store.get(game_id)
+    if not record:
         await sio.emit("error", {"msg": "对局不存在"}, to=sid)
         return
+    game = record.game
     
     # 逻辑修正：
     # 1. 如果用户已经是该局玩家 -> 恢复连接
@@ -182,24 +252,20 @@ async def join_room(sid, data):
     # 场景2: 新玩家加入空位
     elif game.status == "WAITING":
         if game.black_player_id is None:
-            update_game(game_id, black_player_id=user_id)
+            game_store.update(game_id, black_player_id=user_id)
             is_player = True
         elif game.white_player_id is None:
-            update_game(game_id, white_player_id=user_id)
+            game_store.update(game_id, white_player_id=user_id)
             is_player = True
         
-        # 再次获取以检查状态
-        game = get_game(game_id)
         # 如果两边都有人了，不仅当前这个人算加入，整个游戏状态要变成 PLAYING
         if game.black_player_id and game.white_player_id:
-            update_game(game_id, status="PLAYING")
-            game = get_game(game_id) # 刷新状态
+            game_store.update(game_id, status="PLAYING")
+            # 开局是关键节点，立即落库 (大厅列表读的是数据库)
+            await game_store.flush()
 
             # 广播通知所有人（包括刚加入的人和已经在房间等待的人）
-            from database import get_session
-            with get_session() as session:
-                black_name = game.get_black_username(session)
-                white_name = game.get_white_username(session)
+            black_name, white_name = await run_db(get_player_names, game)
                 
             # 发送更新后的状态给所有人
             await sio.emit("board_update", {
@@ -224,7 +290,7 @@ async def join_room(sid, data):
     
     # 如果游戏引擎不存在，创建
     if game_id not in active_games:
-        active_games[game_id] = GameEngine(initial_moves=game.get_moves())
+        active_games[game_id] = load_engine(record)
         print(f"[Room] Loaded game {game_id} from DB into memory.")
     
     engine = active_games[game_id]
@@ -239,15 +305,11 @@ async def join_room(sid, data):
          
     # 发送当前状态
     # 获取用户名
-    from database import get_session
-    black_name = "等待加入..."
-    white_name = "等待加入..."
-    with get_session() as session:
-        black_name = game.get_black_username(session)
-        white_name = game.get_white_username(session)
+    black_name, white_name = await run_db(get_player_names, game)
 
     await sio.emit("board_update", {
         "moves": engine.get_current_stones(),
+        "seq": engine.seq,
         "turn": game.current_turn,
         "last_move": engine.moves[-1][1] if engine.moves else None,
         "status": game.status,
@@ -256,49 +318,175 @@ async def join_room(sid, data):
         "white_id": game.white_player_id,
         "black_name": black_name,
         "white_name": white_name,
-        "ai_winrates": game.get_ai_winrates() 
+        "ai_winrates": game_store.get_winrates(game_id)
     }, to=sid)
     
     print(f"[Room] User {user_id} 加入对局 {game_id} (Player: {is_player})")
 
+@sio.event
+async def request_snapshot(sid, data):
+    """客户端发现 board_delta 序号断档时，单独补发一次完整盘面"""
+    game_id = data.get("game_id")
+    engine = active_games.get(game_id)
+    game = await game_store.get_game(game_id)
+    if not engine or not game:
+        return
+
+    await sio.emit("board_update", {
+        "moves": engine.get_current_stones(),
+        "seq": engine.seq,
+        "turn": game.current_turn,
+        "last_move": engine.moves[-1][1] if engine.moves else None,
+        "status": game.status
+    }, to=sid)
+
+# 胜率曲线：只有最新局面以正常搜索量分析，被跳过的局面空闲时低搜索量批量补齐
+WINRATE_VISITS = 100
+BACKFILL_VISITS = 32
+
+def schedule_winrate(game_id, moves):
+    """为最新局面安排胜率分析；同一对局更早的胜率任务和补齐任务 (排队或运行中) 都会被取消"""
+    ai_scheduler.cancel((game_id, "backfill"))
+    asyncio.create_task(run_analysis_and_save(game_id, list(moves)))
+
+def is_current_line(game_id, moves):
+    """moves 是否仍是对局当前棋谱的前缀 (悔棋后旧分析结果作废)"""
+    engine = active_games.get(game_id)
+    if engine is None:
+        return True
+    return len(engine.moves) >= len(moves) and engine.moves[:len(moves)] == moves
+
 async def run_analysis_and_save(game_id, moves):
-    """后台运行 KataGo 分析并将胜率存入数据库"""
+    """后台运行 KataGo 分析并将胜率按手数存入数据库"""
     try:
         # Fast analysis for tracking (low visits)
-        result = await asyncio.to_thread(ai_engine.analyze, moves, max_visits=100)
+        result = await ai_scheduler.analyze(
+            "winrate", moves, max_visits=WINRATE_VISITS, key=(game_id, "winrate")
+        )
         
         if "rootInfo" in result and "winrate" in result["rootInfo"]:
              winrate = result["rootInfo"]["winrate"]
-             
-             # Save to DB
-             from database import get_session, Game
-             with get_session() as session:
-                 game = session.get(Game, game_id)
-                 if game:
-                     winrates = game.get_ai_winrates()
-                     winrates.append(round(winrate, 3))
-                     game.set_ai_winrates(winrates)
-                     session.add(game)
-                     session.commit()
-                     print(f"[AI] Saved winrate for game {game_id}: {winrate:.3f}")
-                     
-                     # Broadcast winrate update
-                     await sio.emit("winrate_update", {
-                         "game_id": game_id,
-                         "winrates": winrates
-                     }, room=f"game_{game_id}")
+             if await publish_winrates(game_id, moves, {len(moves): winrate}):
+                 print(f"[AI] Saved winrate for game {game_id} move {len(moves)}: {winrate:.3f}")
 
     except Exception as e:
         print(f"[AI] Background analysis failed: {e}")
 
+def search_winrates(moves, result, played):
+    """从一次对弈搜索中取出两个局面的胜率：当前局面取 rootInfo，
+    落下 played 之后的局面取该着手的 moveInfo，省去各自单独的胜率查询"""
+    updates = {}
+    if "winrate" in result.get("rootInfo", {}):
+        updates[len(moves)] = result["rootInfo"]["winrate"]
+    for info in result.get("moveInfos", []):
+        if info["move"] == played:
+            updates[len(moves) + 1] = info["winrate"]
+            break
+    return updates
+
+async def publish_winrates(game_id, moves, updates):
+    """按手数保存胜率并广播新增的部分；moves 已不是当前棋谱 (悔棋) 时丢弃。存在空缺时安排一次补齐"""
+    if not updates or not is_current_line(game_id, moves):
+        return False
+    written = game_store.save_winrates(game_id, updates)
+    if not written:
+        return False
+
+    # Broadcast winrate update (只发这次写入的 {手数: 胜率}，客户端按手数合并)
+    await sio.emit("winrate_update", {
+        "game_id": game_id,
+        "updates": written
+    }, room=f"game_{game_id}")
+
+    latest = max(written)
+    missing = game_store.missing_winrates(game_id, latest)
+    if missing:
+        asyncio.create_task(backfill_winrates(game_id, moves[:latest - 1], missing))
+    return True
+
+async def backfill_winrates(game_id, moves, missing):
+    """用一次 analyzeTurns 补齐被跳过的局面；有新着手时会被取消，待下次再补"""
+    result = await ai_scheduler.analyze_turns(
+        "review", moves, max_visits=BACKFILL_VISITS, turns=missing, key=(game_id, "backfill")
+    )
+    if isinstance(result, dict) or not is_current_line(game_id, moves):
+        return
+
+    written = game_store.save_winrates(game_id, {t["turn"]: t["winrate"] for t in result})
+    if not written:
+        return
+    print(f"[AI] Back-filled {len(written)} winrates for game {game_id}")
+    await sio.emit("winrate_update", {
+        "game_id": game_id,
+        "updates": written
+    }, room=f"game_{game_id}")
+
+# AI 对弈的搜索量；预读 (pondering) 用同样的搜索量，命中时结果可直接使用
+AI_MOVE_VISITS = 600
+PONDER_ROOT_VISITS = 100
+PONDER_TOP_N = 3
+ponder_jobs = {}  # {game_id: {预测的对方着手: (着手序列, asyncio.Task)}}
+
+def start_pondering(game_id, moves):
+    """AI 落子后趁对方思考，在后台低优先级预先搜索对方最可能的几手应对"""
+    stop_pondering(game_id)
+    ponder_jobs[game_id] = {}
+    asyncio.create_task(ponder(game_id, list(moves)))
+
+async def ponder(game_id, moves):
+    root = await ai_scheduler.analyze(
+        "ponder", moves, max_visits=PONDER_ROOT_VISITS, key=(game_id, "ponder", None)
+    )
+    jobs = ponder_jobs.get(game_id)
+    if jobs is None or "moveInfos" not in root or not is_current_line(game_id, moves):
+        return
+
+    color = 'B' if len(moves) % 2 == 0 else 'W'
+    for info in root["moveInfos"][:PONDER_TOP_N]:
+        line = moves + [[color, info["move"]]]
+        task = asyncio.create_task(ai_scheduler.analyze(
+            "ponder", line, max_visits=AI_MOVE_VISITS, key=(game_id, "ponder", info["move"])
+        ))
+        jobs[info["move"]] = (line, task)
+
+def stop_pondering(game_id, keep=None):
+    """取消对局的预读；keep 为实际出现的着手序列，命中且已在搜索 (或已完成) 时保留该搜索并返回其 Task
+
+    命中的预读若还在 ponder 队列里排队，就取消它，由调用方按 ai_move 优先级重新搜索，
+    免得 AI 落子排在其他对局的预读后面。
+    """
+    jobs = ponder_jobs.pop(game_id, None)
+    if jobs is None:
+        return None
+    ai_scheduler.cancel((game_id, "ponder", None))
+    kept = None
+    for move, (line, task) in jobs.items():
+        key = (game_id, "ponder", move)
+        if keep is not None and line == keep and (task.done() or ai_scheduler.claim(key)):
+            kept = task
+        else:
+            ai_scheduler.cancel(key)
+            # 还没提交到调度器 (如正在查缓存) 的也一并取消
+            task.cancel()
+    return kept
+
 async def handle_ai_move(game_id, current_moves, ai_color):
     """处理AI落子逻辑"""
-    await asyncio.sleep(1.0) # 思考时间模拟
+    pondered = stop_pondering(game_id, keep=current_moves)
     
     try:
         # 1. Generate Move
-        # 使用较高的 visits 来作为对弈对手
-        result = await asyncio.to_thread(ai_engine.analyze, current_moves, max_visits=600)
+        # 使用较高的 visits 来作为对弈对手；预读命中时直接等待已在进行 (或已完成) 的搜索
+        result = await pondered if pondered else {"error": "not pondered"}
+        # 预读可能被负载预算压到很低的搜索量，不足 ai_move 当前预算的不用
+        min_visits, _ = ai_scheduler.classes["ai_move"].budget(AI_MOVE_VISITS)
+        if "error" in result or result.get("rootInfo", {}).get("visits", 0) < min_visits:
+            result = ai_engine.lookup(current_moves, AI_MOVE_VISITS)
+        if result:
+            print(f"[AI] Game {game_id}: 命中预读结果，跳过思考等待")
+        else:
+            await asyncio.sleep(1.0) # 思考时间模拟
+            result = await ai_scheduler.analyze("ai_move", current_moves, max_visits=AI_MOVE_VISITS)
         
         best_move_coord = None
         if result and "moveInfos" in result and len(result["moveInfos"]) > 0:
@@ -307,9 +495,9 @@ async def handle_ai_move(game_id, current_moves, ai_color):
         if not best_move_coord:
              best_move_coord = "PASS" 
 
-        # 2. Apply Move
-        if game_id not in active_games:
-             active_games[game_id] = GameEngine(initial_moves=current_moves)
+        # 2. Apply Move (思考期间对局已结束则放弃)
+        if game_id not in active_games or not game_store.peek(game_id):
+             return
         engine = active_games[game_id]
         
         # Determine color (safely)
@@ -322,19 +510,17 @@ async def handle_ai_move(game_id, current_moves, ai_color):
         
         if success:
              next_turn = 'W' if turn == 'B' else 'B'
-             update_game(game_id, moves_json=json.dumps(engine.moves), current_turn=next_turn)
+             save_moves(game_id, engine, next_turn)
              
              print(f"[AI Move] Game {game_id}: AI ({turn}) plays {best_move_coord}")
              
-             await sio.emit("board_update", {
-                "moves": engine.get_current_stones(),
-                "turn": next_turn,
-                "last_move": best_move_coord,
-                "status": "PLAYING"
-             }, room=f"game_{game_id}")
+             await broadcast_board_change(game_id, engine, next_turn, best_move_coord)
              
-             # Trigger analysis for user
-             asyncio.create_task(run_analysis_and_save(game_id, engine.moves))
+             # 这次搜索同时给出 AI 落子前后两个局面的胜率，无需再单独分析
+             if not await publish_winrates(game_id, list(engine.moves), search_winrates(current_moves, result, best_move_coord)):
+                 schedule_winrate(game_id, engine.moves)
+
+             start_pondering(game_id, engine.moves)
         else:
              print(f"[AI Error] Failed to play move: {error_msg}")
 
@@ -344,26 +530,15 @@ async def handle_ai_move(game_id, current_moves, ai_color):
 async def check_and_trigger_ai_move(game_id):
     """Utility to trigger AI move if it is AI's turn"""
     try: 
-        game = get_game(game_id)
+        game = await game_store.get_game(game_id)
         if not game or game.status != "PLAYING": return
         
         if game_id not in active_games: return
         engine = active_games[game_id]
         
-        from database import get_session, User, select
-        with get_session() as session:
-             ai_user = session.exec(select(User).where(User.username == "KataGo")).first()
-             if not ai_user: return
-             
-             is_ai_turn = False
-             if game.current_turn == 'B' and game.black_player_id == ai_user.id:
-                 is_ai_turn = True
-             elif game.current_turn == 'W' and game.white_player_id == ai_user.id:
-                 is_ai_turn = True
-                 
-             if is_ai_turn:
-                 print(f"[AI] Triggering move for Game {game_id} (Turn {game.current_turn})")
-                 await handle_ai_move(game_id, list(engine.moves), game.current_turn)
+        if is_ai_player(game, game.current_turn):
+            print(f"[AI] Triggering move for Game {game_id} (Turn {game.current_turn})")
+            await handle_ai_move(game_id, list(engine.moves), game.current_turn)
     except Exception as e:
         print(f"[AI Check Error] {e}")
 
@@ -376,8 +551,9 @@ async def request_ai_move(sid, data):
         
         if not user_id: return
 
-        game = get_game(game_id)
-        if not game or game.status != "PLAYING": return
+        record = await game_store.get(game_id)
+        if not record or record.game.status != "PLAYING": return
+        game = record.game
         
         # 轮次验证
         if game.current_turn == 'B' and user_id != game.black_player_id:
@@ -386,40 +562,37 @@ async def request_ai_move(sid, data):
             return
 
         if game_id not in active_games:
-             active_games[game_id] = GameEngine(initial_moves=game.get_moves())
+             active_games[game_id] = load_engine(record)
         engine = active_games[game_id]
         
         # 1. Ask AI for best move (for ME)
         current_moves = list(engine.moves)
-        result = await asyncio.to_thread(ai_engine.analyze, current_moves, max_visits=600)
+        result = await ai_scheduler.analyze("ai_move", current_moves, max_visits=AI_MOVE_VISITS)
         
         best_move_coord = "PASS"
         if result and "moveInfos" in result and len(result["moveInfos"]) > 0:
              best_move_coord = result["moveInfos"][0]["move"]
              
         # 2. Play the move
-        success, error_msg = engine.play_move(game.current_turn, best_move_coord)
+        turn = game.current_turn
+        success, error_msg = engine.play_move(turn, best_move_coord)
         
         if not success:
             await sio.emit("error", {"msg": f"AI落子失败: {error_msg}"}, to=sid)
             return
 
         # 3. Update DB
-        next_turn = 'W' if game.current_turn == 'B' else 'B'
-        update_game(game_id, moves_json=json.dumps(engine.moves), current_turn=next_turn)
+        next_turn = 'W' if turn == 'B' else 'B'
+        save_moves(game_id, engine, next_turn)
         
-        print(f"[AI-Assist] Game {game_id}: {game.current_turn} plays {best_move_coord} (AI Helped)")
+        print(f"[AI-Assist] Game {game_id}: {turn} plays {best_move_coord} (AI Helped)")
 
-        # 4. Trigger Analysis
-        asyncio.create_task(run_analysis_and_save(game_id, engine.moves))
+        # 4. Trigger Analysis (复用刚才的搜索结果)
+        if not await publish_winrates(game_id, list(engine.moves), search_winrates(current_moves, result, best_move_coord)):
+            schedule_winrate(game_id, engine.moves)
 
         # 5. Broadcast
-        await sio.emit("board_update", {
-            "moves": engine.get_current_stones(),
-            "turn": next_turn,
-            "last_move": best_move_coord,
-            "status": "PLAYING"
-        }, room=f"game_{game_id}")
+        await broadcast_board_change(game_id, engine, next_turn, best_move_coord)
         
         # 6. Check for AI Turn (Opponent)
         # Reuse logic from make_move? Or call the util.
@@ -441,10 +614,11 @@ async def make_move(sid, data):
             await sio.emit("error", {"msg": "认证失效，请刷新页面"}, to=sid)
             return
 
-        game = get_game(game_id)
-        if not game or game.status != "PLAYING":
+        record = await game_store.get(game_id)
+        if not record or record.game.status != "PLAYING":
             await sio.emit("error", {"msg": "对局状态不正确"}, to=sid)
             return
+        game = record.game
         
         # 轮次验证
         if game.current_turn == 'B' and user_id != game.black_player_id:
@@ -457,53 +631,44 @@ async def make_move(sid, data):
         # 内存状态恢复
         if game_id not in active_games:
             print(f"[Recover] Reloading game {game_id} engine")
-            active_games[game_id] = GameEngine(initial_moves=game.get_moves())
+            active_games[game_id] = load_engine(record)
 
         engine = active_games[game_id]
-        success, error_msg = engine.play_move(game.current_turn, coord)
+        turn = game.current_turn
+        success, error_msg = engine.play_move(turn, coord)
         
         if not success:
             await sio.emit("error", {"msg": error_msg}, to=sid)
             return
         
-        # 更新数据库
-        next_turn = 'W' if game.current_turn == 'B' else 'B'
-        update_game(game_id, moves_json=json.dumps(engine.moves), current_turn=next_turn)
+        # 更新数据库 (写回缓存)
+        next_turn = 'W' if turn == 'B' else 'B'
+        save_moves(game_id, engine, next_turn)
         
-        print(f"[Move] Game {game_id}: {game.current_turn} plays {coord}. Next: {next_turn}")
-
-        # 触发后台分析
-        asyncio.create_task(run_analysis_and_save(game_id, engine.moves))
+        print(f"[Move] Game {game_id}: {turn} plays {coord}. Next: {next_turn}")
 
         # 广播给房间所有人 (不包含 is_player，因为这是静态身份)
-        await sio.emit("board_update", {
-            "moves": engine.get_current_stones(),
-            "turn": next_turn,
-            "last_move": coord,
-            "status": "PLAYING"
-        }, room=f"game_{game_id}")
+        await broadcast_board_change(game_id, engine, next_turn, coord)
         
         # Check for AI Turn
+        is_ai_turn = False
         try:
-             with get_session() as session:
-                 ai_user = session.exec(select(User).where(User.username == "KataGo")).first()
-                 
-                 if ai_user:
-                     is_ai_turn = False
-                     if next_turn == 'B' and game.black_player_id == ai_user.id:
-                         is_ai_turn = True
-                     elif next_turn == 'W' and game.white_player_id == ai_user.id:
-                         is_ai_turn = True
-                     
-                     if is_ai_turn:
-                         # Important: Pass a COPY of moves or ensure thread safety if needed
-                         # engine.moves is a list, create_task might run later? 
-                         # Actually handle_ai_move waits immediately, but engine.moves might mutate if another move comes?
-                         # Normally user can't move if it's AI turn (frontend blocked), so engine.moves should be stable.
-                         asyncio.create_task(handle_ai_move(game_id, list(engine.moves), next_turn))
+             is_ai_turn = is_ai_player(game, next_turn)
+             if is_ai_turn:
+                 # Important: Pass a COPY of moves or ensure thread safety if needed
+                 # engine.moves is a list, create_task might run later? 
+                 # Actually handle_ai_move waits immediately, but engine.moves might mutate if another move comes?
+                 # Normally user can't move if it's AI turn (frontend blocked), so engine.moves should be stable.
+                 asyncio.create_task(handle_ai_move(game_id, list(engine.moves), next_turn))
         except Exception as e:
             print(f"Error checking AI turn: {e}")
 
+        # 触发后台分析；轮到 AI 时胜率由 AI 的对弈搜索顺带给出
+        if is_ai_turn:
+            ai_scheduler.cancel((game_id, "backfill"))
+        else:
+            schedule_winrate(game_id, engine.moves)
+
     except Exception as e:
         print(f"[Error] make_move error: {str(e)}")
         await sio.emit("error", {"msg": f"系统错误: {str(e)}"}, to=sid)
@@ -514,32 +679,30 @@ async def undo_game(sid, data):
     game_id = data["game_id"]
     engine = active_games.get(game_id)
     
-    if not engine:
+    if not engine or not await game_store.get(game_id):
         return
     
-    success, msg = engine.undo_move()
+    # 支持一次悔多步 (例如人机对局中连同 AI 的应手一起撤回)
+    steps = data.get("steps", 1)
+    if isinstance(steps, bool) or not isinstance(steps, int) or steps < 1:
+        await sio.emit("error", {"msg": "悔棋步数无效"}, to=sid)
+        return
+    success, msg = engine.undo_move(steps)
     if success:
-        game = get_game(game_id)
         next_turn = 'B' if len(engine.moves) % 2 == 0 else 'W'
-        update_game(game_id, moves_json=json.dumps(engine.moves), current_turn=next_turn)
+        save_moves(game_id, engine, next_turn)
         
-        # 同步回滚 AI 胜率数据
-        from database import get_session, Game
-        with get_session() as session:
-            game = session.get(Game, game_id)
-            if game:
-                winrates = game.get_ai_winrates()
-                if winrates:
-                    winrates.pop()
-                    game.set_ai_winrates(winrates)
-                    session.add(game)
-                    session.commit()
-
-        await sio.emit("board_update", {
-            "moves": engine.get_current_stones(),
-            "turn": next_turn,
-            "last_move": engine.moves[-1][1] if engine.moves else None,
-            "status": "PLAYING"
+        # 撤回局面上的胜率分析与预读作废 (被撤回着手的胜率随 Move 记录一起删除)
+        stop_pondering(game_id)
+        ai_scheduler.cancel((game_id, "winrate"))
+        ai_scheduler.cancel((game_id, "backfill"))
+
+        last_move = engine.moves[-1][1] if engine.moves else None
+        await broadcast_board_change(game_id, engine, next_turn, last_move)
+        # 悔棋时下发完整胜率列表，让客户端丢掉被撤回的部分
+        await sio.emit("winrate_update", {
+            "game_id": game_id,
+            "winrates": game_store.get_winrates(game_id)
         }, room=f"game_{game_id}")
 
 @sio.event
@@ -547,7 +710,9 @@ async def resign_game(sid, data):
     """认输"""
     game_id = data["game_id"]
     user_id = user_sessions.get(sid)
-    game = get_game(game_id)
+    game = await game_store.get_game(game_id)
+    if not game:
+        return
     
     if user_id == game.black_player_id:
         winner = 'W'
@@ -556,7 +721,9 @@ async def resign_game(sid, data):
         winner = 'B'
         result = "B+Resign"
     
-    update_game(game_id, status="ENDED", winner=winner, result_detail=result)
+    # 终局立即落库，并释放写回缓存中的对局
+    game_store.update(game_id, status="ENDED", winner=winner, result_detail=result, updated_at=datetime.now())
+    await game_store.close(game_id)
     
     await sio.emit("game_over", {
         "winner": winner,
@@ -564,6 +731,7 @@ async def resign_game(sid, data):
     }, room=f"game_{game_id}")
     
     # 清理内存
+    stop_pondering(game_id)
     if game_id in active_games:
         del active_games[game_id]
 
@@ -580,13 +748,88 @@ async def estimate_score(sid, data):
         moves = data.get("moves", [])
         
     import asyncio
+    # 流式模式：搜索过程中的中间结果通过 analysis_progress 推给请求方，最终结果仍走 ack
+    on_progress = None
+    if data.get("stream"):
+        request_id = data.get("request_id")
+
+        def on_progress(partial):
+            # 在 KataGo 读协程中同步回调，推送另起任务
+            asyncio.create_task(
+                sio.emit("analysis_progress", dict(partial, request_id=request_id), to=sid)
+            )
+
     # Increase visits to get deeper/more stable variations (e.g. 10+ moves)
     # 100 was too fast/shallow resulting in short PVs (4-8 moves)
-    result = await asyncio.to_thread(ai_engine.analyze, moves, max_visits=600)
+    # 客户端按需索取归属数据：ownership (int8 base64) / territory (行程编码)，默认只要 ownership
+    result = await ai_scheduler.analyze(
+        "interactive", moves, max_visits=600, on_progress=on_progress,
+        ownership=data.get("ownership", True), territory=data.get("territory", False)
+    )
     
     # 直接透传整个结果给前端，前端去决定怎么展示
     return result
 
+# 终局复盘：整盘棋一次 analyzeTurns 批量分析
+REVIEW_VISITS = 200
+review_tasks = {}  # {game_id: asyncio.Task}
+review_partials = {}  # {game_id: {turn: [winrate, scoreLead, bestMove]}}
+
+@sio.event
+async def request_review(sid, data):
+    """请求复盘数据：已保存的直接返回，否则启动批量分析并通过 review_progress 陆续推送"""
+    game_id = data.get("game_id")
+    game = await run_db(get_game, game_id)
+    if not game or game.status != "ENDED":
+        return {"error": "只能复盘已结束的对局"}
+
+    moves = await run_db(game.get_moves)
+    review = game.get_review()
+    stored = review and len(review["turns"]) == len(moves) + 1
+    if stored and review.get("visits", 0) >= REVIEW_VISITS:
+        return {"turns": review["turns"], "complete": True}
+
+    await sio.enter_room(sid, f"review_{game_id}")
+    if game_id not in review_tasks:
+        # 负载下降档算出的复盘搜索量不足，先展示旧结果，重新计算后逐个局面替换
+        review_partials[game_id] = dict(enumerate(review["turns"])) if stored else {}
+        review_tasks[game_id] = asyncio.create_task(run_review(game_id, moves))
+
+    partial = review_partials.get(game_id, {})
+    return {"turns": [partial.get(t) for t in range(len(moves) + 1)], "complete": False}
+
+async def run_review(game_id, moves):
+    """后台执行复盘，每算完一个局面就推送给正在看复盘的客户端"""
+    partial = review_partials[game_id]
+
+    def on_turn(turn):
+        # 在 KataGo 读协程中同步回调，推送另起任务
+        partial[turn["turn"]] = [turn["winrate"], turn["scoreLead"], turn["bestMove"]]
+        asyncio.create_task(
+            sio.emit("review_progress", dict(turn, game_id=game_id), room=f"review_{game_id}")
+        )
+
+    try:
+        result = await ai_scheduler.analyze_turns(
+            "review", moves, max_visits=REVIEW_VISITS, on_turn=on_turn
+        )
+        if isinstance(result, dict) and "error" in result:
+            print(f"[Review] Game {game_id} 复盘失败: {result['error']}")
+            await sio.emit("review_done", {"game_id": game_id, "error": result["error"]}, room=f"review_{game_id}")
+            return
+
+        turns = [[t["winrate"], t["scoreLead"], t["bestMove"]] for t in result]
+        # 记录实际搜索量 (排队时可能被降档)，不足 REVIEW_VISITS 的下次请求时重新计算
+        visits = min((t["visits"] for t in result), default=0)
+        await run_db(save_review, game_id, {"visits": visits, "turns": turns})
+        print(f"[Review] Game {game_id} 复盘完成 ({len(turns)} 个局面)")
+        await sio.emit("review_done", {"game_id": game_id, "turns": turns}, room=f"review_{game_id}")
+    except Exception as e:
+        print(f"[Review] Game {game_id} 复盘出错: {e}")
+    finally:
+        review_tasks.pop(game_id, None)
+        review_partials.pop(game_id, None)
+
 async def perform_counting(game_id):
     """【Util】执行终局点目并结束游戏"""
     print(f"[Counting] 执行点目结算 (game_id={game_id})...")
@@ -594,10 +837,9 @@ async def perform_counting(game_id):
     engine = active_games.get(game_id)
     if not engine:
         print(f"[Warning] Counting: Game {game_id} 内存丢失，尝试从数据库恢复...")
-        db_game = get_game(game_id)
-        if db_game:
-            moves = db_game.get_moves()
-            engine = GameEngine(initial_moves=moves)
+        record = await game_store.get(game_id)
+        if record:
+            engine = load_engine(record)
             active_games[game_id] = engine
             print(f"[Recover] Game {game_id} 恢复成功")
         else:
@@ -607,7 +849,7 @@ async def perform_counting(game_id):
 
     try:
         # 增加 visit 以保证点目准确
-        ai_result = await asyncio.to_thread(ai_engine.analyze, engine.moves, max_visits=1000)
+        ai_result = await ai_scheduler.analyze("counting", engine.moves, max_visits=1000)
     except Exception as e:
         print(f"[Error] AI analyze failed: {e}")
         return
@@ -625,7 +867,9 @@ async def perform_counting(game_id):
     winner = 'B' if score > 0 else 'W'
     res_str = f"{winner}+{abs(score):.1f}"
     
-    update_game(game_id, status="ENDED", winner=winner, result_detail=res_str)
+    if await game_store.get(game_id):
+        game_store.update(game_id, status="ENDED", winner=winner, result_detail=res_str, updated_at=datetime.now())
+        await game_store.close(game_id)
     print(f"[Counting] 游戏结束: {res_str}")
     
     await sio.emit("game_over", {
@@ -634,6 +878,7 @@ async def perform_counting(game_id):
         "reason": "点目判定"
     }, room=f"game_{game_id}")
     
+    stop_pondering(game_id)
     if game_id in active_games:
         del active_games[game_id]
 
@@ -646,7 +891,7 @@ async def request_counting(sid, data):
     
     print(f"[Counting] Request from {sid} (uid={requester_id}) for game {game_id}")
     
-    game = get_game(game_id)
+    game = await game_store.get_game(game_id)
     if not game:
         return
 
@@ -660,7 +905,7 @@ async def request_counting(sid, data):
     # 检查对手是否为 AI (KataGo)
     is_vs_ai = False
     if opponent_id:
-        opp_name = get_username(opponent_id)
+        opp_name = await run_db(get_username, opponent_id)
         if opp_name and "KataGo" in opp_name:
             is_vs_ai = True
             
@@ -0,0 +1,57 @@
+import base64
+from array import array
+
+# ownership 量化为 int8：-127 (白方) ~ 127 (黑方)
+OWNERSHIP_SCALE = 127
+# 形势判断中归属一方的阈值 (与前端绘制一致)
+TERRITORY_THRESHOLD = 0.2
+
+def encode_ownership(values):
+    """KataGo 的 361 个浮点归属值 -> base64 编码的 int8 数组 (行优先，第 0 行为棋盘最上方)"""
+    quantized = array('b', (max(-OWNERSHIP_SCALE, min(OWNERSHIP_SCALE, round(v * OWNERSHIP_SCALE))) for v in values))
+    return base64.b64encode(quantized.tobytes()).decode('ascii')
+
+def decode_ownership(encoded):
+    """encode_ownership 的逆过程，返回 int8 列表"""
+    return array('b', base64.b64decode(encoded)).tolist()
+
+def territory_rle(encoded):
+    """int8 ownership -> 行程编码的归属图，如 "40.3B2W"：B 黑 / W 白 / . 未定"""
+    limit = TERRITORY_THRESHOLD * OWNERSHIP_SCALE
+    runs = []
+    prev, count = None, 0
+    for v in decode_ownership(encoded):
+        owner = 'B' if v > limit else 'W' if v < -limit else '.'
+        if owner == prev:
+            count += 1
+        else:
+            if prev is not None:
+                runs.append(f"{count}{prev}")
+            prev, count = owner, 1
+    if prev is not None:
+        runs.append(f"{count}{prev}")
+    return ''.join(runs)
+
+def map_ownership(encoded, table, size=19):
+    """按点映射表 (点编号 y * size + x，y=0 为第 1 路) 变换 int8 ownership 的朝向"""
+    if not encoded:
+        return encoded
+    values = decode_ownership(encoded)
+    mapped = array('b', bytes(len(values)))
+    for row in range(size):
+        for col in range(size):
+            point = table[(size - 1 - row) * size + col]
+            y, x = divmod(point, size)
+            mapped[(size - 1 - y) * size + x] = values[row * size + col]
+    return base64.b64encode(mapped.tobytes()).decode('ascii')
+
+def shape_result(result, ownership=False, territory=False):
+    """按调用方需要裁剪分析结果：去掉不需要的 ownership，按需附上 territory"""
+    shaped = dict(result)
+    encoded = shaped.pop("ownership", None)
+    territory_map = shaped.pop("territory", None)
+    if ownership and encoded:
+        shaped["ownership"] = encoded
+    if territory and (territory_map or encoded):
+        shaped["territory"] = territory_map or territory_rle(encoded)
+    return shaped
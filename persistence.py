@@ -0,0 +1,230 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from database import load_game_record, flush_games, run_db
+
+# 写回间隔 (秒)：对局改动最迟在变脏后这么久落库，也就是进程崩溃时最多丢失的时间窗口
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "0.5"))
+# 写入失败后的重试间隔从 DB_FLUSH_INTERVAL 开始逐次翻倍，最长不超过这么久 (秒)
+DB_RETRY_MAX = float(os.environ.get("DB_RETRY_MAX", "30"))
+
+class GameRecord:
+    """一局对局的内存状态 (Game 行 + 棋谱 + 胜率) 与尚未落库的改动"""
+
+    def __init__(self, game, moves, winrates):
+        self.game = game
+        self.moves = moves
+        self.winrates = winrates  # 第 n 手在下标 n-1，未分析的为 None
+        self.fields = {}  # 待写入的 Game 列
+        self.rewrite_from = None  # Move 表中从这一手起需要重写
+        self.winrate_updates = {}  # rewrite_from 之前的着手上待写入的胜率
+        self.dirty_since = None
+
+    def take_changes(self):
+        """取出待写入的改动 (flush_games 的一项) 并清空"""
+        tail = []
+        if self.rewrite_from is not None:
+            for move_no in range(self.rewrite_from, len(self.moves) + 1):
+                color, coord = self.moves[move_no - 1]
+                winrate = self.winrates[move_no - 1] if move_no <= len(self.winrates) else None
+                tail.append((color, coord, winrate))
+        change = (self.game.id, self.fields, self.rewrite_from, tail, self.winrate_updates)
+        self.fields, self.rewrite_from, self.winrate_updates = {}, None, {}
+        self.dirty_since = None
+        return change
+
+    def restore_changes(self, change):
+        """写入失败时把改动放回，与之后的新改动合并"""
+        _, fields, rewrite_from, _, winrates = change
+        self.fields = {**fields, **self.fields}
+        if rewrite_from is not None:
+            self.rewrite_from = min(rewrite_from, self.rewrite_from or rewrite_from)
+        for move_no, winrate in winrates.items():
+            if move_no <= len(self.moves):
+                self.winrate_updates.setdefault(move_no, winrate)
+
+class GameStore:
+    """对局的写回 (write-behind) 缓存
+
+    已加载的对局以内存状态为准：落子、轮次、胜率只改内存并标记为脏，
+    脏对局每隔 DB_FLUSH_INTERVAL 秒在 db_executor 中用一个事务批量落库；
+    终局等关键节点调用 flush() / close() 立即落库。
+    """
+
+    def __init__(self, interval=DB_FLUSH_INTERVAL):
+        self.interval = interval
+        self.records = {}  # game_id -> GameRecord
+        self.dirty = set()
+        self.closing = set()  # 已结束、落库成功后即释放的对局
+        self.flush_task = None
+        self.retry_delay = interval
+        self.flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.flushed_games = 0
+        self.errors = 0
+
+    async def get(self, game_id):
+        """返回对局的 GameRecord (首次访问时从数据库加载)，对局不存在时返回 None"""
+        record = self.records.get(game_id)
+        if record is None:
+            loaded = await run_db(load_game_record, game_id)
+            if loaded is None:
+                return None
+            # 加载期间可能已有别的协程加载过
+            record = self.records.setdefault(game_id, GameRecord(*loaded))
+        return record
+
+    async def get_game(self, game_id):
+        record = await self.get(game_id)
+        return record.game if record else None
+
+    def peek(self, game_id):
+        return self.records.get(game_id)
+
+    def update(self, game_id, **fields):
+        """修改已加载对局的 Game 列"""
+        record = self.records[game_id]
+        for key, value in fields.items():
+            setattr(record.game, key, value)
+        record.fields.update(fields)
+        self._mark_dirty(game_id, record)
+
+    def save_moves(self, game_id, moves, **fields):
+        """让内存棋谱与 moves 一致；落子/悔棋只改动末尾，落库时只重写改动的几手"""
+        record = self.records[game_id]
+        old = record.moves
+        common = min(len(old), len(moves))
+        while common and old[common - 1] != moves[common - 1]:
+            common -= 1
+        if common < len(old) or common < len(moves):
+            if record.rewrite_from is None or common + 1 < record.rewrite_from:
+                record.rewrite_from = common + 1
+            record.moves = [list(m) for m in moves]
+            del record.winrates[len(moves):]
+            record.winrate_updates = {n: w for n, w in record.winrate_updates.items() if n <= len(moves)}
+        self.update(game_id, updated_at=datetime.now(), **fields)
+
+    def save_winrates(self, game_id, updates):
+        """按手数写入胜率 {手数: 黑方胜率}，返回实际写入的部分 (对局未加载或着手已不存在的跳过)"""
+        record = self.records.get(game_id)
+        if record is None:
+            return {}
+        written = {}
+        for move_no, winrate in updates.items():
+            if not 1 <= move_no <= len(record.moves):
+                continue
+            winrate = round(winrate, 3)
+            if len(record.winrates) < move_no:
+                record.winrates.extend([None] * (move_no - len(record.winrates)))
+            record.winrates[move_no - 1] = winrate
+            if record.rewrite_from is None or move_no < record.rewrite_from:
+                record.winrate_updates[move_no] = winrate
+            written[move_no] = winrate
+        if written:
+            self._mark_dirty(game_id, record)
+        return written
+
+    def get_winrates(self, game_id):
+        record = self.records.get(game_id)
+        if record is None:
+            return []
+        winrates = list(record.winrates)
+        while winrates and winrates[-1] is None:
+            winrates.pop()
+        return winrates
+
+    def missing_winrates(self, game_id, before):
+        """第 1 ~ before-1 手中尚未写入胜率的手数"""
+        record = self.records.get(game_id)
+        if record is None:
+            return []
+        winrates = record.winrates
+        return [n for n in range(1, before) if n > len(winrates) or winrates[n - 1] is None]
+
+    def _mark_dirty(self, game_id, record):
+        if record.dirty_since is None:
+            record.dirty_since = time.monotonic()
+        self.dirty.add(game_id)
+        self._schedule(self.interval)
+
+    def _schedule(self, delay):
+        """安排一次延迟写入；已有等待中或正在写入的任务时由它负责 (写完若仍有脏对局会再安排)"""
+        task = self.flush_task
+        if task is None or task.done() or task is asyncio.current_task():
+            self.flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self):
+        """立即把所有脏对局写入数据库 (一个事务)，返回是否成功
+
+        写入期间产生的新改动、以及写入失败放回的改动，都会在结束时重新安排写入；
+        失败时按 retry_delay 退避重试。
+        """
+        async with self.flush_lock:
+            batch = []
+            for game_id in self.dirty:
+                record = self.records.get(game_id)
+                if record is not None:
+                    batch.append(record.take_changes())
+            self.dirty.clear()
+            ok = True
+            if batch:
+                try:
+                    await run_db(flush_games, batch)
+                    self.flushes += 1
+                    self.flushed_games += len(batch)
+                except Exception as e:
+                    ok = False
+                    self.errors += 1
+                    print(f"[Store] 写入数据库失败，{self.retry_delay:.1f} 秒后重试: {e}")
+                    for change in batch:
+                        record = self.records.get(change[0])
+                        if record is not None:
+                            record.restore_changes(change)
+                            if record.dirty_since is None:
+                                record.dirty_since = time.monotonic()
+                            self.dirty.add(change[0])
+            if ok:
+                self.retry_delay = self.interval
+                for game_id in list(self.closing):
+                    if game_id not in self.dirty:
+                        self.closing.discard(game_id)
+                        self.records.pop(game_id, None)
+                if self.dirty:
+                    self._schedule(self.interval)
+            else:
+                self._schedule(self.retry_delay)
+                self.retry_delay = min(self.retry_delay * 2, DB_RETRY_MAX)
+            return ok
+
+    async def close(self, game_id):
+        """对局结束：立即落库，成功后释放内存状态；失败时保留，等重试写入成功后再释放"""
+        if game_id in self.records:
+            self.closing.add(game_id)
+            await self.flush()
+
+    def discard(self, game_id):
+        """对局已从数据库删除，丢弃内存状态与未写入的改动"""
+        self.records.pop(game_id, None)
+        self.dirty.discard(game_id)
+        self.closing.discard(game_id)
+
+    def stats(self):
+        oldest = min((r.dirty_since for r in self.records.values() if r.dirty_since), default=None)
+        return {
+            "games": len(self.records),
+            "dirty": len(self.dirty),
+            "flush_interval": self.interval,
+            "flushes": self.flushes,
+            "flushed_games": self.flushed_games,
+            "errors": self.errors,
+            "retry_delay": self.retry_delay,
+            "oldest_dirty_ms": round((time.monotonic() - oldest) * 1000, 1) if oldest else 0.0
+        }
+
+game_store = GameStore()
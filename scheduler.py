@@ -0,0 +1,343 @@
+import asyncio
+import time
+from collections import deque
+
+from ai import ai_engine, QueryHandle
+from ownership import shape_result
+
+# 任务类别按优先级从高到低排列：(类别, 同时运行的查询上限)
+# AI 落子 > 终局点目 > 交互式形势判断/推荐 > 后台胜率曲线 > 批量复盘 > AI 预读
+PRIORITY_CLASSES = [
+    ("ai_move", 4),
+    ("counting", 2),
+    ("interactive", 4),
+    ("winrate", 2),
+    ("review", 1),
+    ("ponder", 2),
+]
+
+# 可抢占的类别：服务器繁忙时不再启动，已在进行的也会被取消
+PREEMPTIBLE_CLASSES = {"ponder"}
+# 可抢占类别的排队上限：队列已满时新提交直接返回 {"error": "busy"}，免得后台任务无限堆积
+# (AI 预读每局最多排 PONDER_TOP_N 条，见 main.py)
+QUEUE_LIMITS = {"ponder": 3}
+# 其他类别的在途 + 排队查询达到这个数即视为繁忙
+BUSY_THRESHOLD = 2
+
+# 负载下的访问量预算：类别 -> (p95 延迟目标秒数, 访问量下限, 降档时是否用 maxTime 封顶)
+# 点目需要准确，下限高且不限时；目标为 None 的类别只按排队深度降档
+VISIT_BUDGETS = {
+    "ai_move": (3.0, 150, True),
+    "counting": (10.0, 800, False),
+    "interactive": (4.0, 200, True),
+    "winrate": (5.0, 32, False),
+    "review": (None, 32, False),
+    "ponder": (None, 50, False),
+}
+# p95 按最近这么多次查询计算，每完成 BUDGET_ADJUST_EVERY 次调整一次预算系数：
+# 超过目标时乘以 BUDGET_BACKOFF，低于目标一半时乘以 BUDGET_RECOVER (最多回到 1)
+LATENCY_WINDOW = 20
+BUDGET_ADJUST_EVERY = 5
+BUDGET_BACKOFF = 0.8
+BUDGET_RECOVER = 1.25
+MIN_BUDGET_SCALE = 0.05
+# maxTime 的最小值 (秒)，免得排队太久的查询几乎不搜索
+MIN_MAX_TIME = 0.5
+
+# 传给 KataGo 的 priority 字段 (越大越先被分析线程处理)
+KATAGO_PRIORITIES = {name: len(PRIORITY_CLASSES) - i for i, (name, _) in enumerate(PRIORITY_CLASSES)}
+
+class JobClass:
+    """一个优先级类别：等待队列 + 并发计数 + 访问量预算 + 统计"""
+
+    def __init__(self, name, limit, budget=(None, 1, False)):
+        self.name = name
+        self.limit = limit
+        self.target, self.min_visits, self.time_capped = budget
+        self.waiters = deque()  # 等待运行名额的 Future
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.shared = 0
+        self.max_queued = 0
+        self.total_wait = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # 最近查询的总耗时 (含排队)
+        self.scale = 1.0  # 由延迟反馈调整的预算系数
+        self.budgeted = 0  # 按预算发出的查询数
+        self.requested_visits = 0
+        self.budget_visits = 0
+        self.reduced = 0
+        self.last_visits = None
+
+    def p95(self):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def budget(self, max_visits, waited=0.0):
+        """按当前负载给出本次查询的 (访问量, maxTime)
+
+        本次查询没有排队 (waited 为 0) 且身后也没有排队时按请求值搜索；否则访问量 = 请求值 × 延迟反馈系数 ÷ (1 + 排队数 / 并发上限)，
+        不低于访问量下限 (也不高于请求值)。降档且该类别限时时，maxTime 为延迟目标减去已排队的时间。
+        """
+        if not self.waiters and not waited:
+            return max_visits, None
+        depth = len(self.waiters) / self.limit
+        visits = int(max_visits * self.scale / (1 + depth))
+        visits = min(max_visits, max(visits, self.min_visits))
+        max_time = None
+        if visits < max_visits and self.time_capped and self.target:
+            max_time = round(max(MIN_MAX_TIME, self.target - waited), 2)
+        return visits, max_time
+
+    def record(self, requested, visits, latency):
+        self.budgeted += 1
+        self.requested_visits += requested
+        self.budget_visits += visits
+        self.last_visits = visits
+        if visits < requested:
+            self.reduced += 1
+        self.latencies.append(latency)
+        if self.target and self.budgeted % BUDGET_ADJUST_EVERY == 0:
+            p95 = self.p95()
+            if p95 > self.target:
+                self.scale = max(MIN_BUDGET_SCALE, self.scale * BUDGET_BACKOFF)
+            elif p95 < self.target / 2:
+                self.scale = min(1.0, self.scale * BUDGET_RECOVER)
+
+    def stats(self):
+        started = self.completed + self.running
+        return {
+            "limit": self.limit,
+            "queued": len(self.waiters),
+            "running": self.running,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "shared": self.shared,
+            "max_queued": self.max_queued,
+            "avg_wait_ms": round(self.total_wait / started * 1000, 1) if started else 0.0,
+            "p95_ms": round(self.p95() * 1000, 1),
+            "target_p95_ms": self.target * 1000 if self.target else None,
+            "budget_scale": round(self.scale, 3),
+            "min_visits": self.min_visits,
+            "last_visits": self.last_visits,
+            "avg_requested_visits": round(self.requested_visits / self.budgeted) if self.budgeted else 0,
+            "avg_visits": round(self.budget_visits / self.budgeted) if self.budgeted else 0,
+            "reduced": self.reduced
+        }
+
+class Job:
+    """一个已提交的查询：KataGo 句柄 + 排队时等待的 Future"""
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self.key = key
+        self.handle = QueryHandle()
+        self.waiter = None
+        self.started = False  # 已拿到运行名额
+
+    def cancel(self):
+        self.handle.cancel()
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(False)
+
+class AnalysisScheduler:
+    """按优先级类别调度 KataGo 查询
+
+    每个类别有独立的并发上限，超出的查询在类别队列里排队 (FIFO)；
+    高优先级类别不会被后台任务占满名额。查询本身还带上 KataGo 的 priority，
+    使引擎内部的分析线程优先处理 AI 落子等紧急查询。命中缓存的查询不占名额。
+
+    带 key 提交的查询 (如 (game_id, "winrate")) 会取代同一 key 下更早的查询：
+    旧查询若仍在排队则直接出队，若已在搜索则让 KataGo terminate，
+    两种情况下旧的调用方都得到 {"error": "superseded"}。
+
+    同一局面上正在进行的无 key 搜索是一个共享会话：搜索量不低于它的新请求
+    直接等待这次搜索的结果，不再另发查询。
+
+    PREEMPTIBLE_CLASSES 中的查询只在空闲时运行：繁忙时提交直接返回
+    {"error": "busy"}，其他类别的新查询到来且已繁忙时，它们会被取消。
+
+    调用方给出的 max_visits 是空闲时的访问量；拿到名额时按 VISIT_BUDGETS
+    依据排队深度和近期 p95 延迟压低 (见 JobClass.budget)，实际用量计入 stats()。
+    """
+
+    def __init__(self, engine, classes=PRIORITY_CLASSES, budgets=VISIT_BUDGETS):
+        self.engine = engine
+        self.classes = {
+            name: JobClass(name, limit, budgets.get(name, (None, 1, False))) for name, limit in classes
+        }
+        self.keyed = {}  # key -> 最新的 Job
+        # 局面 (着手元组) -> [访问量, ownership, territory, Task]；访问量在拿到名额前是预算下限，之后为实际预算
+        self.sessions = {}
+
+    async def _acquire(self, job_class, job):
+        """等待运行名额；在排队中被取代时返回 False"""
+        job_class.submitted += 1
+        queued_at = time.monotonic()
+        if job_class.running < job_class.limit and not job_class.waiters:
+            job_class.running += 1
+            return True
+
+        job.waiter = asyncio.get_running_loop().create_future()
+        job_class.waiters.append(job.waiter)
+        job_class.max_queued = max(job_class.max_queued, len(job_class.waiters))
+        try:
+            granted = await job.waiter
+        except asyncio.CancelledError:
+            if job.waiter.done() and not job.waiter.cancelled() and job.waiter.result():
+                # 名额已分配但任务被取消，交还名额
+                self._release(job_class)
+            elif job.waiter in job_class.waiters:
+                job_class.waiters.remove(job.waiter)
+            raise
+        finally:
+            job_class.total_wait += time.monotonic() - queued_at
+
+        if not granted and job.waiter in job_class.waiters:
+            job_class.waiters.remove(job.waiter)
+        return granted
+
+    def _release(self, job_class):
+        job_class.running -= 1
+        while job_class.waiters and job_class.running < job_class.limit:
+            waiter = job_class.waiters.popleft()
+            if not waiter.done():
+                job_class.running += 1
+                waiter.set_result(True)
+
+    async def _run(self, name, func, *args, key=None, session=None, **kwargs):
+        job_class = self.classes[name]
+        if name in PREEMPTIBLE_CLASSES:
+            queue_limit = QUEUE_LIMITS.get(name)
+            if self.busy() or (queue_limit is not None and len(job_class.waiters) >= queue_limit):
+                job_class.cancelled += 1
+                return {"error": "busy"}
+        elif self.busy():
+            self.cancel_preemptible()
+
+        job = Job(name, key)
+        if key is not None:
+            self.cancel(key)
+            self.keyed[key] = job
+
+        submitted_at = time.monotonic()
+        try:
+            if not await self._acquire(job_class, job):
+                job_class.cancelled += 1
+                return {"error": "superseded"}
+            job.started = True
+            requested = kwargs["max_visits"]
+            waited = time.monotonic() - submitted_at if job.waiter else 0.0
+            kwargs["max_visits"], max_time = job_class.budget(requested, waited)
+            if session is not None:
+                session[0] = kwargs["max_visits"]
+            try:
+                result = await func(
+                    *args, priority=KATAGO_PRIORITIES[name], handle=job.handle, max_time=max_time, **kwargs
+                )
+            except asyncio.CancelledError:
+                job.handle.cancel()
+                raise
+            finally:
+                job_class.completed += 1
+                self._release(job_class)
+        finally:
+            if key is not None and self.keyed.get(key) is job:
+                del self.keyed[key]
+
+        if job.handle.cancelled:
+            job_class.cancelled += 1
+            return {"error": "superseded"}
+        if not (isinstance(result, dict) and "error" in result):
+            job_class.record(requested, kwargs["max_visits"], time.monotonic() - submitted_at)
+        return result
+
+    def cancel(self, key):
+        """取消 key 下排队或运行中的查询 (没有则忽略)"""
+        job = self.keyed.pop(key, None)
+        if job:
+            job.cancel()
+
+    def claim(self, key):
+        """接管 key 下的查询：已在搜索的从 key 表中摘下，不再被同 key 取代或被抢占，返回 True；
+        仍在排队的直接取消并返回 False (调用方应按自己的类别重新提交)，没有该查询时也返回 False"""
+        job = self.keyed.pop(key, None)
+        if job is None:
+            return False
+        if job.started:
+            return True
+        job.cancel()
+        return False
+
+    def busy(self):
+        """不可抢占类别的在途与排队查询是否已达到 BUSY_THRESHOLD"""
+        load = sum(
+            c.running + len(c.waiters)
+            for name, c in self.classes.items() if name not in PREEMPTIBLE_CLASSES
+        )
+        return load >= BUSY_THRESHOLD
+
+    def cancel_preemptible(self):
+        for key, job in list(self.keyed.items()):
+            if job.name in PREEMPTIBLE_CLASSES:
+                self.cancel(key)
+
+    async def analyze(self, name, moves, max_visits=500, key=None, on_progress=None,
+                      ownership=False, territory=False):
+        """以 name 类别的优先级执行 ai_engine.analyze()"""
+        moves = list(moves)
+        # 负载下不低于当前预算的缓存结果 / 共享搜索即可回答
+        visits, _ = self.classes[name].budget(max_visits)
+        # 内存未命中时在缓存线程里查缓存文件 (重启前算过的局面)
+        cached = await self.engine.lookup_async(moves, visits, ownership, territory)
+        if cached:
+            if key is not None:
+                self.cancel(key)
+            return cached
+
+        position = tuple(tuple(move) for move in moves)
+        session = self.sessions.get(position)
+        if (session and session[0] >= visits and on_progress is None
+                and (session[1] or not ownership) and (session[1] or session[2] or not territory)):
+            # 搭上同一局面正在进行的搜索 (需要中间结果的流式请求、所需字段对方没有的除外)
+            self.classes[name].shared += 1
+            if key is not None:
+                self.cancel(key)
+            result = await asyncio.shield(session[3])
+            return shape_result(result, ownership, territory)
+
+        if key is not None:
+            # 可被取代的查询不作为共享会话，免得取消时连累搭车的请求
+            return await self._run(
+                name, self.engine.search, moves, max_visits=max_visits, key=key, on_progress=on_progress,
+                ownership=ownership, territory=territory
+            )
+
+        # 会话的访问量先取预算下限，拿到名额后 _run 改为实际预算，共享判断按它进行
+        session = [min(max_visits, self.classes[name].min_visits), ownership, territory, None]
+        session[3] = task = asyncio.ensure_future(self._run(
+            name, self.engine.search, moves, max_visits=max_visits, on_progress=on_progress,
+            ownership=ownership, territory=territory, session=session
+        ))
+        self.sessions[position] = session
+        task.add_done_callback(lambda _: self._end_session(position, task))
+        return await asyncio.shield(task)
+
+    def _end_session(self, position, task):
+        session = self.sessions.get(position)
+        if session and session[3] is task:
+            del self.sessions[position]
+
+    async def analyze_turns(self, name, moves, max_visits=200, key=None, **kwargs):
+        return await self._run(
+            name, self.engine.analyze_turns, list(moves), max_visits=max_visits, key=key, **kwargs
+        )
+
+    def stats(self):
+        return {name: job_class.stats() for name, job_class in self.classes.items()}
+
+ai_scheduler = AnalysisScheduler(ai_engine)
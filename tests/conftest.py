@@ -0,0 +1,8 @@
+import os
+import sys
+
+# 测试直接导入仓库根目录下的模块 (game、database 等)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ai.py 导入时会创建全局的分析缓存；测试中不要在工作目录下生成 analysis_cache.db
+os.environ.setdefault("ANALYSIS_CACHE_DB", "")
@@ -0,0 +1,76 @@
+"""分析缓存：持久化文件在重启后仍能回答调度器的查询，不再向引擎发起搜索"""
+import asyncio
+
+from ai import KataGoPool, RULES, KOMI
+from analysis_cache import AnalysisCache
+from ownership import encode_ownership
+from scheduler import AnalysisScheduler
+
+MOVES = [["B", "D4"], ["W", "Q16"], ["B", "C3"]]
+RESULT = {
+    "rootInfo": {"winrate": 0.55, "scoreLead": 1.5, "visits": 600},
+    "moveInfos": [{"move": "R4", "pv": ["R4", "D16"], "winrate": 0.55, "visits": 400, "order": 0}],
+}
+
+def restarted_pool(path):
+    """模拟重启：新的缓存对象打开同一个文件；引擎的搜索只记录调用"""
+    pool = KataGoPool(cache=AnalysisCache(path=str(path)))
+    searches = []
+
+    async def search(moves, **kwargs):
+        searches.append(moves)
+        return {"error": "engine unavailable"}
+
+    pool.search = search
+    return pool, searches
+
+def test_scheduler_hits_persisted_cache_after_restart(tmp_path):
+    path = tmp_path / "analysis_cache.db"
+    cache = AnalysisCache(path=str(path))
+    cache.put(MOVES, 600, RULES, KOMI, RESULT)
+    cache.flush()
+
+    pool, searches = restarted_pool(path)
+    assert pool.cache.stats()["entries"] == 0
+    result = asyncio.run(AnalysisScheduler(pool).analyze("ai_move", MOVES, max_visits=600))
+    assert searches == []
+    assert result["moveInfos"][0]["move"] == "R4"
+    assert pool.cache.stats()["hits"] == 1
+
+def test_persisted_cache_answers_symmetric_position(tmp_path):
+    path = tmp_path / "analysis_cache.db"
+    cache = AnalysisCache(path=str(path))
+    cache.put(MOVES, 600, RULES, KOMI, RESULT)
+    cache.flush()
+
+    # 左右翻转：D4 -> Q4, Q16 -> D16, C3 -> R3, R4 -> C4
+    mirrored = [["B", "Q4"], ["W", "D16"], ["B", "R3"]]
+    pool, searches = restarted_pool(path)
+    result = asyncio.run(AnalysisScheduler(pool).analyze("interactive", mirrored, max_visits=200))
+    assert searches == []
+    assert result["moveInfos"][0]["move"] == "C4"
+
+def test_shallower_entry_does_not_answer_deeper_request(tmp_path):
+    path = tmp_path / "analysis_cache.db"
+    cache = AnalysisCache(path=str(path))
+    cache.put(MOVES, 100, RULES, KOMI, RESULT)
+    cache.flush()
+
+    pool, searches = restarted_pool(path)
+    result = asyncio.run(AnalysisScheduler(pool).analyze("ai_move", MOVES, max_visits=600))
+    assert searches == [MOVES]
+    assert result == {"error": "engine unavailable"}
+
+def test_ownership_result_replaces_deeper_plain_entry():
+    cache = AnalysisCache(path=None)
+    cache.put(MOVES, 600, RULES, KOMI, RESULT)
+    with_ownership = dict(RESULT, ownership=encode_ownership([0.5] * 361))
+    cache.put(MOVES, 200, RULES, KOMI, with_ownership)
+    assert cache.get(MOVES, 200, RULES, KOMI, need_ownership=True)["ownership"]
+
+    # 之后更深但不带 ownership 的结果不会把它挤掉
+    cache.put(MOVES, 800, RULES, KOMI, RESULT)
+    assert cache.get(MOVES, 200, RULES, KOMI, need_ownership=True)["ownership"]
+    # 同样带 ownership 的结果仍按搜索量取更深的
+    cache.put(MOVES, 400, RULES, KOMI, with_ownership)
+    assert cache.get(MOVES, 400, RULES, KOMI, need_ownership=True)
@@ -0,0 +1,159 @@
+"""game.py 棋盘与 sgfmill 的差分测试：tests/sgf 下的棋谱 (提子、打劫、自提) 与随机对局
+(含悔棋、检查点重新加载)，逐手比较落子是否合法与盘面是否一致"""
+import pathlib
+import random
+
+import pytest
+
+from game import GameEngine
+
+boards = pytest.importorskip("sgfmill.boards")
+sgf = pytest.importorskip("sgfmill.sgf")
+
+SGF_DIR = pathlib.Path(__file__).parent / "sgf"
+
+COLUMNS = "ABCDEFGHJKLMNOPQRST"
+
+class Reference:
+    """sgfmill 实现的参照引擎：sgfmill Board.play 负责提子与自提，另加全局同形禁手"""
+
+    def __init__(self, size=19):
+        self.size = size
+        self.history = [boards.Board(size)]
+        self.positions = [frozenset()]
+
+    @property
+    def board(self):
+        return self.history[-1]
+
+    def play(self, color, coord):
+        col, row = COLUMNS.find(coord[:1].upper()), coord[1:]
+        if col < 0 or not row.isdigit() or not 1 <= int(row) <= self.size:
+            return False
+        row = int(row) - 1
+        if self.board.get(row, col) is not None:
+            return False
+        board = self.board.copy()
+        board.play(row, col, color.lower())
+        position = frozenset(board.list_occupied_points())
+        if position in self.positions:
+            return False
+        self.history.append(board)
+        self.positions.append(position)
+        return True
+
+    def undo(self, steps):
+        for _ in range(min(steps, len(self.history) - 1)):
+            self.history.pop()
+            self.positions.pop()
+
+    def stones(self):
+        return sorted(
+            ["B" if color == "b" else "W", f"{COLUMNS[col]}{row + 1}"]
+            for color, (row, col) in self.board.list_occupied_points()
+        )
+
+def random_coord(rng, lo, hi):
+    if rng.random() < 0.02:
+        return rng.choice(["PASS", "Z5", "A0", "A20", "T19"])
+    return COLUMNS[rng.randrange(lo, hi)] + str(rng.randint(lo + 1, hi))
+
+def play_random_game(seed, length=400):
+    rng = random.Random(seed)
+    engine, reference = GameEngine(), Reference()
+    # 限制在一块区域内落子，制造密集的对杀、提子与打劫
+    lo = rng.randint(0, 10)
+    hi = min(19, lo + rng.randint(4, 19))
+    checkpoint = None
+    color = "B"
+    for i in range(length):
+        coord = random_coord(rng, lo, hi)
+        ok, _ = engine.play_move(color, coord)
+        assert ok == reference.play(color, coord), (seed, i, coord)
+        if ok:
+            color = "W" if color == "B" else "B"
+        if rng.random() < 0.03:
+            steps = rng.randint(1, 5)
+            engine.undo_move(steps)
+            reference.undo(steps)
+            color = "B" if len(engine.moves) % 2 == 0 else "W"
+        if rng.random() < 0.02:
+            checkpoint = engine.checkpoint()
+        assert sorted(engine.get_current_stones()) == reference.stones(), (seed, i)
+    return engine, checkpoint
+
+def sgf_moves(path):
+    """棋谱主线上的着手 [颜色, GTP 坐标] (跳过停一手)"""
+    game = sgf.Sgf_game.from_bytes(path.read_bytes())
+    moves = []
+    for node in game.get_main_sequence():
+        color, point = node.get_move()
+        if color is not None and point is not None:
+            row, col = point
+            moves.append([color.upper(), f"{COLUMNS[col]}{row + 1}"])
+    return moves
+
+@pytest.mark.parametrize("path", sorted(SGF_DIR.glob("*.sgf")), ids=lambda p: p.stem)
+def test_sgf_records_match_sgfmill(path):
+    engine, reference = GameEngine(), Reference()
+    moves = sgf_moves(path)
+    assert moves
+    rejected = 0
+    for i, (color, coord) in enumerate(moves):
+        ok, _ = engine.play_move(color, coord)
+        assert ok == reference.play(color, coord), (path.name, i, color, coord)
+        rejected += not ok
+        assert sorted(engine.get_current_stones()) == reference.stones(), (path.name, i)
+    # 每份棋谱都记录了至少一手应被拒绝的着手 (打劫回提、自杀、落在已有棋子上)
+    assert rejected
+
+    reloaded = GameEngine(initial_moves=[list(m) for m in engine.moves])
+    assert reloaded.get_current_stones() == engine.get_current_stones()
+    assert reloaded.history_hashes == engine.history_hashes
+
+@pytest.mark.parametrize("seed", range(300))
+def test_random_games_match_sgfmill(seed):
+    engine, checkpoint = play_random_game(seed)
+    moves = [list(m) for m in engine.moves]
+
+    # 完整重放与从检查点加载都应还原出同样的盘面与历史局面
+    for reloaded in (GameEngine(initial_moves=moves), GameEngine(initial_moves=moves, checkpoint=checkpoint)):
+        assert reloaded.get_current_stones() == engine.get_current_stones()
+        assert reloaded.board_hash == engine.board_hash
+        assert reloaded.history_hashes == engine.history_hashes
+
+def test_ko_and_suicide():
+    engine = GameEngine()
+    # 打劫：白 D4 提黑 E4 后，黑不能立即回提
+    for color, coord in [("B", "D3"), ("W", "E3"), ("B", "C4"), ("W", "F4"), ("B", "D5"),
+                         ("W", "E5"), ("B", "E4"), ("W", "D4")]:
+        assert engine.play_move(color, coord)[0], coord
+    assert not engine.play_move("B", "E4")[0]
+    # 单子自杀会还原出之前的局面，按同形禁手拒绝
+    assert engine.play_move("B", "A1")[0]
+    assert engine.play_move("W", "A2")[0]
+    assert engine.play_move("B", "K10")[0]
+    assert engine.play_move("W", "B1")[0]
+    assert not engine.play_move("B", "A1")[0]
+
+@pytest.mark.parametrize("steps", [0, -1])
+def test_undo_rejects_non_positive_steps(steps):
+    engine = GameEngine()
+    assert engine.play_move("B", "D4")[0]
+    seq = engine.seq
+    with pytest.raises(ValueError):
+        engine.undo_move(steps)
+    assert engine.moves == [["B", "D4"]]
+    assert engine.seq == seq
+
+def test_undo_multiple_steps():
+    engine = GameEngine()
+    for color, coord in [("B", "D4"), ("W", "Q16"), ("B", "C3")]:
+        assert engine.play_move(color, coord)[0]
+    assert engine.undo_move(2) == (True, None)
+    assert engine.moves == [["B", "D4"]]
+    assert engine.get_current_stones() == [["B", "D4"]]
+    # 超过已有手数时悔到空盘
+    assert engine.undo_move(5) == (True, None)
+    assert engine.moves == [] and engine.board_hash == 0
+    assert engine.undo_move() == (False, "无棋可悔")
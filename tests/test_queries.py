@@ -0,0 +1,79 @@
+"""大厅列表与历史记录查询的执行计划：应走 ix_game_status_updated_at，且不需要临时 B-tree 排序"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, text
+from sqlmodel import update
+
+import database
+from database import Game
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'lulugo.db'}")
+    monkeypatch.setattr(database, "engine", engine)
+    database.init_db()
+    players = [database.create_user(name)[2].id for name in ("alice", "bob")]
+    start = datetime(2026, 1, 1)
+    for i in range(30):
+        game = database.create_game(players[i % 2], "B")
+        status = ("WAITING", "PLAYING", "ENDED")[i % 3]
+        with database.get_session() as session:
+            session.exec(update(Game).where(Game.id == game.id)
+                         .values(status=status, updated_at=start + timedelta(minutes=i)))
+            session.commit()
+    yield engine
+    engine.dispose()
+
+def query_plans(engine, call):
+    """执行 call()，返回其间每条 SELECT game 语句的 EXPLAIN QUERY PLAN 明细"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM game" in statement:
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        call()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert statements
+    plans = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+            plans.append(" | ".join(row[-1] for row in rows))
+    return plans
+
+@pytest.mark.parametrize("call", [
+    database.get_waiting_games,
+    database.get_playing_games,
+    database.get_history_games,
+    lambda: database.get_history_games(limit=5, player_id=2),
+], ids=["waiting", "playing", "history", "history-player"])
+def test_lobby_queries_use_status_index(db, call):
+    for plan in query_plans(db, call):
+        assert "ix_game_status_updated_at" in plan, plan
+        assert "USE TEMP B-TREE" not in plan, plan
+
+def test_history_cursors_use_status_index(db):
+    first = database.get_history_games(limit=3)
+    assert first["next_cursor"] and first["latest_cursor"]
+    for cursor in ("before", "since"):
+        value = first["next_cursor"] if cursor == "before" else first["latest_cursor"]
+        for plan in query_plans(db, lambda: database.get_history_games(limit=3, **{cursor: value})):
+            assert "ix_game_status_updated_at" in plan, plan
+            assert "USE TEMP B-TREE" not in plan, plan
+
+def test_history_pages_cover_all_games_once(db):
+    seen, cursor = [], None
+    while True:
+        page = database.get_history_games(limit=4, before=cursor)
+        seen += [game["id"] for game in page["games"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    with db.connect() as conn:
+        ended = conn.execute(text("SELECT id FROM game WHERE status = 'ENDED' ORDER BY updated_at DESC, id DESC")).all()
+    assert seen == [row[0] for row in ended]